@@ -1,39 +1,69 @@
 import os
+import atexit
+import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from SpiderKeeperX.app.spider.controller import api_router
-from SpiderKeeperX.config import DB_PATH
-from SpiderKeeperX.app.spider.model import Base, engine
-from SpiderKeeperX.app.proxy.spiderctrl import SpiderAgent
+from SpiderKeeperX.app.spider.model import engine, SessionScopeMiddleware, RequestMetricsMiddleware, Project, \
+    JobInstance
+from SpiderKeeperX.app.spider.migration import migrate
+from SpiderKeeperX.app.proxy.spiderctrl import agent
 from SpiderKeeperX.app.proxy.contrib.scrapy import ScrapydProxy
+from SpiderKeeperX.app.util import events
+from SpiderKeeperX.app.util.tasks import task_runner
+from SpiderKeeperX.app.util.navigation import navigation
 import SpiderKeeperX.config as config
 
-agent = SpiderAgent()
 
 def regist_server():
     if config.SERVER_TYPE == 'scrapyd':
         for server in config.SERVERS:
             agent.regist(ScrapydProxy(server))
 
-scheduler = BackgroundScheduler()
+# system jobs live in memory and are added by every instance, spider cron jobs are shared in the database
+scheduler = BackgroundScheduler(jobstores={
+    'default': MemoryJobStore(),
+    'spider': SQLAlchemyJobStore(engine=engine, tablename='skx_scheduler_job'),
+})
+leader_elector = None
 
 
 def start_scheduler():
+    global leader_elector
     from SpiderKeeperX.app.schedulers.common import sync_job_execution_status_job, sync_spiders, \
-        reload_runnable_spider_job_execution
-    scheduler.add_job(sync_job_execution_status_job, 'interval', seconds=5, id='sys_sync_status')
+        reload_runnable_spider_job_execution, purge_job_execution_job, on_job_instance_changed, observe_scheduler_event
+    from SpiderKeeperX.app.schedulers.leader import LeaderElector
+    events.subscribe(events.JOB_INSTANCE_CHANGED, on_job_instance_changed)
+    scheduler.add_job(sync_job_execution_status_job, 'interval', seconds=config.SYNC_STATUS_INTERVAL,
+                      id='sys_sync_status')
     scheduler.add_job(sync_spiders, 'interval', seconds=10, id='sys_sync_spiders')
-    scheduler.add_job(reload_runnable_spider_job_execution, 'interval', seconds=30, id='sys_reload_job')
-    scheduler.start()
+    scheduler.add_job(reload_runnable_spider_job_execution, 'interval', seconds=config.SCHEDULE_RECONCILE_INTERVAL,
+                      id='sys_reload_job')
+    scheduler.add_job(purge_job_execution_job, 'interval', seconds=config.RETENTION_INTERVAL, id='sys_purge_job')
+    scheduler.add_listener(observe_scheduler_event, EVENT_JOB_SUBMITTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+    # followers keep the scheduler paused, they still write cron job edits to the shared store
+    scheduler.start(paused=True)
+
+    def on_elected():
+        scheduler.modify_job('sys_reload_job', next_run_time=datetime.datetime.now())
+        scheduler.resume()
+
+    leader_elector = LeaderElector(config.SCHEDULER_INSTANCE_ID, on_elected, scheduler.pause)
+    leader_elector.start()
+    atexit.register(leader_elector.stop)
 
 def init_db():
     print("init db.")
-    if not os.path.exists(DB_PATH):
+    db_path = engine.url.database
+    if engine.url.get_backend_name() == 'sqlite' and db_path and not os.path.exists(db_path):
         print("create db file.")
-        with open(DB_PATH, mode="wb"):
+        with open(db_path, mode="wb"):
             pass
-    Base.metadata.create_all(engine, Base.metadata.tables.values(), checkfirst=True)
+    print("schema version %s." % migrate())
 
 def init_all():
     init_db()
@@ -41,8 +71,15 @@ def init_all():
 
 def build_app():
     app = FastAPI()
+    app.add_middleware(SessionScopeMiddleware)
+    app.add_middleware(RequestMetricsMiddleware)
     app.mount("/static", StaticFiles(directory="./SpiderKeeperX/app/static"), name="static")
     app.include_router(api_router)
+    events.subscribe(events.PROJECT_CHANGED, Project.invalidate)
+    events.subscribe(events.JOB_INSTANCE_CHANGED, JobInstance.invalidate)
+    events.subscribe(events.PROJECT_CHANGED, navigation.invalidate_projects)
+    events.subscribe(events.SPIDERS_CHANGED, navigation.invalidate_spiders)
     start_scheduler()
     regist_server()
+    task_runner.start()
     return app
\ No newline at end of file
@@ -1,10 +1,16 @@
 import datetime, time
-
-import requests
+from urllib.parse import urlparse
 
 from SpiderKeeperX.app.proxy.spiderctrl import SpiderServiceProxy
 from SpiderKeeperX.app.spider.model import SpiderStatus, Project, SpiderInstance
-from SpiderKeeperX.app.util.http import request
+from SpiderKeeperX.app.util.http import request, request_post, MultipartFileBody
+from SpiderKeeperX.app.util.metrics import Counter, Histogram
+from SpiderKeeperX.config import HTTP_CONNECT_TIMEOUT, HTTP_DEPLOY_READ_TIMEOUT, HTTP_RETRY_TIMES
+
+SCRAPYD_REQUEST_SECONDS = Histogram('skx_scrapyd_request_seconds', 'scrapyd api call latency including retries',
+                                    ['daemon', 'endpoint'])
+SCRAPYD_REQUEST_ERRORS = Counter('skx_scrapyd_request_errors_total', 'scrapyd api calls without a usable response',
+                                 ['daemon', 'endpoint'])
 
 
 class ScrapydProxy(SpiderServiceProxy):
@@ -19,8 +25,28 @@ class ScrapydProxy(SpiderServiceProxy):
     def _scrapyd_url(self):
         return self.server
 
+    def _request(self, request_type, url, **kwargs):
+        '''
+        request() that feeds the daemon health, an unhealthy daemon gets no retries
+        '''
+        if not self.health.healthy:
+            kwargs['retry_times'] = 1
+        start = time.time()
+        data = request(request_type, url, **kwargs)
+        self._observe(url, time.time() - start, data is not None)
+        return data
+
+    def _observe(self, url, latency, ok):
+        endpoint = urlparse(url).path.rsplit('/', 1)[-1]
+        SCRAPYD_REQUEST_SECONDS.observe(latency, daemon=self.server, endpoint=endpoint)
+        if ok:
+            self.health.record_success(latency)
+        else:
+            SCRAPYD_REQUEST_ERRORS.inc(daemon=self.server, endpoint=endpoint)
+            self.health.record_failure(latency, 'no response from %s' % url)
+
     def get_project_list(self):
-        data = request("get", self._scrapyd_url() + "/listprojects.json", return_type="json")
+        data = self._request("get", self._scrapyd_url() + "/listprojects.json", return_type="json")
         result = []
         if data:
             for project_name in data['projects']:
@@ -31,12 +57,13 @@ class ScrapydProxy(SpiderServiceProxy):
 
     def delete_project(self, project_name):
         post_data = dict(project=project_name)
-        data = request("post", self._scrapyd_url() + "/delproject.json", data=post_data, return_type="json")
+        data = self._request("post", self._scrapyd_url() + "/delproject.json", data=post_data, return_type="json",
+                             idempotent=True)
         return True if data and data['status'] == 'ok' else False
 
     def get_spider_list(self, project_name):
-        data = request("get", self._scrapyd_url() + "/listspiders.json?project=%s" % project_name,
-                       return_type="json")
+        data = self._request("get", self._scrapyd_url() + "/listspiders.json?project=%s" % project_name,
+                             return_type="json")
         result = []
         if data and data['status'] == 'ok':
             for spider_name in data['spiders']:
@@ -45,12 +72,17 @@ class ScrapydProxy(SpiderServiceProxy):
                 result.append(spider_instance)
         return result
 
-    def get_daemon_status(self):
-        pass
+    def get_daemon_status(self, timeout=None, retry_times=HTTP_RETRY_TIMES):
+        data = self._request("get", self._scrapyd_url() + "/daemonstatus.json", return_type="json", timeout=timeout,
+                             retry_times=retry_times)
+        if data and data.get('status') == 'ok':
+            return dict(running=data.get('running', 0), pending=data.get('pending', 0),
+                        finished=data.get('finished', 0))
+        return None
 
-    def get_job_list(self, project_name, spider_status=None):
-        data = request("get", self._scrapyd_url() + "/listjobs.json?project=%s" % project_name,
-                       return_type="json")
+    def get_job_list(self, project_name, spider_status=None, timeout=None, retry_times=HTTP_RETRY_TIMES):
+        data = self._request("get", self._scrapyd_url() + "/listjobs.json?project=%s" % project_name,
+                             return_type="json", timeout=timeout, retry_times=retry_times)
         result = {SpiderStatus.PENDING: [], SpiderStatus.RUNNING: [], SpiderStatus.FINISHED: []}
         if data and data['status'] == 'ok':
             for _status in self.spider_status_name_dict.keys():
@@ -66,23 +98,40 @@ class ScrapydProxy(SpiderServiceProxy):
     def start_spider(self, project_name, spider_name, arguments):
         post_data = dict(project=project_name, spider=spider_name)
         post_data.update(arguments)
-        data = request("post", self._scrapyd_url() + "/schedule.json", data=post_data, return_type="json")
+        data = self._request("post", self._scrapyd_url() + "/schedule.json", data=post_data, return_type="json")
         return data['jobid'] if data and data['status'] == 'ok' else None
 
     def cancel_spider(self, project_name, job_id):
         post_data = dict(project=project_name, job=job_id)
-        data = request("post", self._scrapyd_url() + "/cancel.json", data=post_data, return_type="json")
+        data = self._request("post", self._scrapyd_url() + "/cancel.json", data=post_data, return_type="json",
+                             idempotent=True)
         return data != None
 
-    def deploy(self, project_name, file_path):
-        with open(file_path, 'rb') as f:
-            eggdata = f.read()
-        res = requests.post(self._scrapyd_url() + '/addversion.json', data={
-            'project': project_name,
-            'version': int(time.time()),
-            'egg': eggdata,
-        })
-        return res.text if res.status_code == 200 else None
+    def deploy(self, project_name, file_path, version=None):
+        '''
+        stream the egg to addversion
+        :return: (ok, message)
+        '''
+        body = MultipartFileBody(dict(project=project_name, version=version or int(time.time())), 'egg', file_path,
+                                 filename='%s.egg' % project_name)
+        # same project and version can be added again, so the upload is safe to retry
+        start = time.time()
+        try:
+            res = request_post(self._scrapyd_url() + '/addversion.json', data=body,
+                               headers={'Content-Type': body.content_type},
+                               timeout=(HTTP_CONNECT_TIMEOUT, HTTP_DEPLOY_READ_TIMEOUT), idempotent=True)
+        finally:
+            body.close()
+        self._observe(self._scrapyd_url() + '/addversion.json', time.time() - start, res is not None)
+        if res is None:
+            return False, 'no response'
+        try:
+            data = res.json()
+        except ValueError:
+            return False, 'status %s: %s' % (res.status_code, res.text[:200])
+        if res.status_code == 200 and data.get('status') == 'ok':
+            return True, res.text
+        return False, data.get('message') or res.text[:200]
 
     def log_url(self, project_name, spider_name, job_id):
         return self._scrapyd_url() + '/logs/%s/%s/%s.log' % (project_name, spider_name, job_id)
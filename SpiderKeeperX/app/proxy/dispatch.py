@@ -0,0 +1,235 @@
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from sqlalchemy.exc import NoResultFound
+
+from SpiderKeeperX.app.proxy.spiderctrl import agent
+from SpiderKeeperX.app.spider.model import JobInstance, JobPriority, session
+from SpiderKeeperX.app.util.metrics import Gauge, Histogram
+from SpiderKeeperX.config import DISPATCH_WORKERS, DISPATCH_QUEUE_SIZE, DISPATCH_RATE_LIMIT, DISPATCH_RATE_BURST, \
+    DISPATCH_DAEMON_CONCURRENCY, DISPATCH_SLOT_POLL
+
+logger = logging.getLogger("[DISPATCH]")
+
+
+class TokenBucket(object):
+    '''
+    allows rate calls per second on average and bursts of up to burst calls
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        take one token, sleep until one is available
+        '''
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+class LaunchDispatcher(object):
+    '''
+    queue between the cron triggers and the daemons. launches are taken highest priority first,
+    paced by a global rate limit and capped per daemon, so hundreds of cron jobs firing on the
+    same minute reach the daemons smoothly instead of all at once. with max_proc configured a
+    launch is held until a daemon has a free process, rather than waiting as pending on a full one.
+    a launch whose daemon is full goes back to the queue pinned to that daemon with its original
+    priority and order, workers only take launches they can start right away
+    '''
+
+    def __init__(self, agent, workers=DISPATCH_WORKERS, max_size=DISPATCH_QUEUE_SIZE, rate=DISPATCH_RATE_LIMIT,
+                 burst=DISPATCH_RATE_BURST, daemon_concurrency=DISPATCH_DAEMON_CONCURRENCY):
+        self.agent = agent
+        self.workers = workers
+        self.max_size = max_size
+        self.daemon_concurrency = daemon_concurrency
+        self.rate_limiter = TokenBucket(rate, burst)
+        # (-priority, seq, job_instance_id, enqueued_at, server), server is '' until the daemons are chosen
+        self._queue = []
+        # job_instance_id -> launches waiting
+        self._queued_ids = collections.Counter()
+        self._seq = itertools.count()
+        # server -> launches in flight
+        self._inflight = collections.Counter()
+        self._condition = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        with self._condition:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name='skx-dispatch-%s' % i, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def qsize(self):
+        return len(self._queue)
+
+    def inflight(self):
+        with self._condition:
+            return dict(self._inflight)
+
+    def submit(self, job_instance):
+        '''
+        queue a launch of the job instance, a job instance already waiting is not queued twice
+        :param job_instance:
+        :return: True if queued
+        '''
+        self.start()
+        priority = job_instance.priority if job_instance.priority is not None else JobPriority.NORMAL
+        with self._condition:
+            if self._queued_ids[job_instance.id]:
+                logger.info('job instance %s is already waiting for launch' % job_instance.id)
+                return False
+            if len(self._queue) >= self.max_size:
+                logger.error('dispatch queue full, launch of job instance %s dropped' % job_instance.id)
+                return False
+            self._push((-priority, next(self._seq), job_instance.id, time.time(), ''))
+        return True
+
+    def _push(self, item):
+        heapq.heappush(self._queue, item)
+        self._queued_ids[item[2]] += 1
+        self._condition.notify()
+
+    def _requeue(self, item, server):
+        '''
+        put a launch back pinned to its full daemon, it keeps its place among launches of the same priority
+        '''
+        with self._condition:
+            self._push(item[:4] + (server,))
+
+    def _free(self, server):
+        if self._inflight[server] >= self.daemon_concurrency:
+            return False
+        free_slots = self.agent.free_slots(server)
+        return free_slots is None or free_slots > self._inflight[server]
+
+    def _has_free_slot(self, spider_service_instance):
+        return self._free(spider_service_instance.server)
+
+    def _any_free_slot(self):
+        return any(self._free(spider_service_instance.server)
+                   for spider_service_instance in self.agent.spider_service_instances)
+
+    def _try_acquire_slot(self, server):
+        with self._condition:
+            if not self._free(server):
+                return False
+            self._inflight[server] += 1
+            return True
+
+    def _release_slot(self, server):
+        with self._condition:
+            self._inflight[server] -= 1
+            self._condition.notify_all()
+
+    def _next(self):
+        '''
+        highest priority launch that can start now, pinned launches need their daemon free,
+        the others any daemon
+        '''
+        free = {}
+
+        def startable(item):
+            server = item[4]
+            if server not in free:
+                free[server] = self._free(server) if server else self._any_free_slot()
+            return free[server]
+
+        if startable(self._queue[0]):
+            return heapq.heappop(self._queue)
+        for item in sorted(self._queue)[1:]:
+            if startable(item):
+                self._queue.remove(item)
+                heapq.heapify(self._queue)
+                return item
+        return None
+
+    def _take(self):
+        with self._condition:
+            while True:
+                item = self._next() if self._queue else None
+                if item:
+                    break
+                # free processes show up with the status sync, so poll instead of waiting for a notify
+                self._condition.wait(DISPATCH_SLOT_POLL if self._queue else None)
+            self._queued_ids[item[2]] -= 1
+            if not self._queued_ids[item[2]]:
+                del self._queued_ids[item[2]]
+            if item[4]:
+                # reserved for the worker, released by dispatch
+                self._inflight[item[4]] += 1
+            return item
+
+    def dispatch(self, item):
+        '''
+        launch one queued item, daemons without a free slot get the launch back in the queue
+        '''
+        _, _, job_instance_id, _, server = item
+        reserved = server
+        try:
+            try:
+                job_instance = JobInstance.find_job_instance_by_id(job_instance_id)
+            except NoResultFound:
+                return
+            if server:
+                targets = [spider_service_instance for spider_service_instance in self.agent.spider_service_instances
+                           if spider_service_instance.server == server]
+            else:
+                targets = self.agent.select_daemons(job_instance, available=self._has_free_slot)
+            for leader in targets:
+                if leader.server == reserved:
+                    reserved = None
+                elif not self._try_acquire_slot(leader.server):
+                    self._requeue(item, leader.server)
+                    continue
+                try:
+                    self.rate_limiter.acquire()
+                    self.agent.launch(job_instance, leader)
+                finally:
+                    self._release_slot(leader.server)
+        finally:
+            if reserved:
+                self._release_slot(reserved)
+
+    def _run(self):
+        while True:
+            item = self._take()
+            job_instance_id, enqueued_at = item[2], item[3]
+            DISPATCH_WAIT_SECONDS.observe(time.time() - enqueued_at)
+            logger.debug('launch job instance %s after %.3fs in queue' % (job_instance_id, time.time() - enqueued_at))
+            try:
+                self.dispatch(item)
+            except Exception as e:
+                logger.error('launch job instance %s failed: %s' % (job_instance_id, e))
+                session.rollback()
+            finally:
+                session.remove()
+
+
+dispatcher = LaunchDispatcher(agent)
+
+DISPATCH_WAIT_SECONDS = Histogram('skx_dispatch_wait_seconds', 'time a launch waited in the dispatch queue')
+Gauge('skx_dispatch_queue_depth', 'launches waiting in the dispatch queue', callback=dispatcher.qsize)
+Gauge('skx_dispatch_inflight', 'launches in flight by daemon', ['daemon'], callback=dispatcher.inflight)
@@ -0,0 +1,82 @@
+import threading
+import time
+
+from SpiderKeeperX.config import HEALTH_EWMA_ALPHA, HEALTH_FAILURE_THRESHOLD, HEALTH_ERROR_RATE_THRESHOLD, \
+    HEALTH_OPEN_SECONDS
+
+
+class DaemonHealth(object):
+    '''
+    health of one daemon fed by every call made to it, with a circuit breaker:
+    closed - healthy, used for placement and polling
+    open - too many errors, skipped until HEALTH_OPEN_SECONDS passed
+    half_open - polled again as a probe, the next call result closes or reopens it
+    '''
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, server):
+        self.server = server
+        self.state = self.CLOSED
+        self.latency_ewma = None  # seconds
+        self.error_rate = 0.0  # ewma of failed calls
+        self.consecutive_failures = 0
+        self.last_seen = None  # time of the last successful call
+        self.last_error = None
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def _update_latency(self, latency):
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma = HEALTH_EWMA_ALPHA * latency + (1 - HEALTH_EWMA_ALPHA) * self.latency_ewma
+
+    def record_success(self, latency):
+        with self._lock:
+            self._update_latency(latency)
+            self.error_rate = (1 - HEALTH_EWMA_ALPHA) * self.error_rate
+            self.consecutive_failures = 0
+            self.last_seen = time.time()
+            self.state = self.CLOSED
+            self.opened_at = None
+
+    def record_failure(self, latency, error=None):
+        with self._lock:
+            self._update_latency(latency)
+            self.error_rate = HEALTH_EWMA_ALPHA + (1 - HEALTH_EWMA_ALPHA) * self.error_rate
+            self.consecutive_failures += 1
+            self.last_error = error
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= HEALTH_FAILURE_THRESHOLD or \
+                    self.error_rate >= HEALTH_ERROR_RATE_THRESHOLD:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+    def refresh(self):
+        '''
+        move an open breaker to half open once its cool down passed
+        :return: state
+        '''
+        with self._lock:
+            if self.state == self.OPEN and time.time() - self.opened_at >= HEALTH_OPEN_SECONDS:
+                self.state = self.HALF_OPEN
+            return self.state
+
+    @property
+    def healthy(self):
+        return self.state == self.CLOSED
+
+    @property
+    def pollable(self):
+        '''
+        open daemons are not called, half open ones are probed
+        '''
+        return self.refresh() != self.OPEN
+
+    def to_dict(self):
+        return dict(server=self.server,
+                    state=self.state,
+                    latency_ewma=self.latency_ewma,
+                    error_rate=self.error_rate,
+                    consecutive_failures=self.consecutive_failures,
+                    last_seen=self.last_seen,
+                    last_error=self.last_error)
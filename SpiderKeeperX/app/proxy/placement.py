@@ -0,0 +1,86 @@
+import hashlib
+import random
+
+from SpiderKeeperX.config import SERVER_WEIGHTS, PLACEMENT_AFFINITY_SLACK
+
+
+def daemon_load(daemon_loads, server):
+    '''
+    :param daemon_loads: {server: dict(running=, pending=)}
+    :param server:
+    :return: running + pending jobs of the daemon, 0 if unknown
+    '''
+    load = daemon_loads.get(server)
+    return load['running'] + load['pending'] if load else 0
+
+
+class PlacementPolicy(object):
+    '''
+    picks the daemons a job instance is launched on
+    '''
+
+    def select(self, candidates, daemon_loads, job_instance, count):
+        '''
+        :param candidates: spider service proxies
+        :param daemon_loads: {server: dict(running=, pending=)}
+        :param job_instance:
+        :param count: wanted daemons, never more than the candidates
+        :return: distinct spider service proxies
+        '''
+        raise NotImplementedError
+
+
+class RandomPolicy(PlacementPolicy):
+    def select(self, candidates, daemon_loads, job_instance, count):
+        return random.sample(candidates, min(count, len(candidates)))
+
+
+class LeastLoadedPolicy(PlacementPolicy):
+    def select(self, candidates, daemon_loads, job_instance, count):
+        # shuffle first so equally loaded daemons share the work
+        candidates = random.sample(candidates, len(candidates))
+        return sorted(candidates, key=lambda candidate: daemon_load(daemon_loads, candidate.server))[:count]
+
+
+class WeightedPolicy(PlacementPolicy):
+    '''
+    least loaded relative to the SERVER_WEIGHTS capacity of each daemon, default weight is 1
+    '''
+
+    def select(self, candidates, daemon_loads, job_instance, count):
+        candidates = random.sample(candidates, len(candidates))
+        return sorted(candidates, key=lambda candidate: (daemon_load(daemon_loads, candidate.server) + 1) /
+                                                        SERVER_WEIGHTS.get(candidate.server, 1))[:count]
+
+
+class SpiderAffinityPolicy(PlacementPolicy):
+    '''
+    keeps a spider on the same daemons (rendezvous hashing), unless they are busier than
+    the least loaded daemon by more than PLACEMENT_AFFINITY_SLACK jobs
+    '''
+
+    def select(self, candidates, daemon_loads, job_instance, count):
+        if not candidates:
+            return []
+        spider_key = '%s:%s' % (job_instance.project_id, job_instance.spider_name)
+        min_load = min(daemon_load(daemon_loads, candidate.server) for candidate in candidates)
+        ranked = sorted(candidates, key=lambda candidate: hashlib.md5(
+            ('%s|%s' % (spider_key, candidate.server)).encode('utf8')).hexdigest())
+        preferred = [candidate for candidate in ranked
+                     if daemon_load(daemon_loads, candidate.server) <= min_load + PLACEMENT_AFFINITY_SLACK]
+        others = [candidate for candidate in ranked if candidate not in preferred]
+        return (preferred + LeastLoadedPolicy().select(others, daemon_loads, job_instance, len(others)))[:count]
+
+
+PLACEMENT_POLICIES = {
+    'random': RandomPolicy,
+    'least_loaded': LeastLoadedPolicy,
+    'weighted': WeightedPolicy,
+    'affinity': SpiderAffinityPolicy,
+}
+
+
+def get_placement_policy(name):
+    if name not in PLACEMENT_POLICIES:
+        raise ValueError('unknown placement policy %s, choose from %s' % (name, ', '.join(PLACEMENT_POLICIES)))
+    return PLACEMENT_POLICIES[name]()
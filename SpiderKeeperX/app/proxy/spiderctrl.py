@@ -1,13 +1,38 @@
 import datetime
-import random
+import hashlib
+import logging
+import time
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
 
-from SpiderKeeperX.app.spider.model import SpiderStatus, JobExecution, JobInstance, Project, JobPriority, session
+from SpiderKeeperX.app.proxy.health import DaemonHealth
+from SpiderKeeperX.app.proxy.placement import get_placement_policy, daemon_load
+from SpiderKeeperX.app.spider.model import SpiderStatus, JobExecution, JobInstance, Project, JobPriority, \
+    JobRunStats, SpiderDeploy, DeployStatus, session
+from SpiderKeeperX.app.util.logarchive import log_archiver
+from SpiderKeeperX.app.util.metrics import Counter, Histogram
+from SpiderKeeperX.config import SYNC_MAX_WORKERS, SYNC_REQUEST_TIMEOUT, LOG_ARCHIVE_ENABLED, PLACEMENT_POLICY, \
+    DAEMON_MAX_PROC, DAEMON_DEFAULT_MAX_PROC, DEPLOY_MAX_WORKERS, HTTP_RETRY_TIMES
+
+logger = logging.getLogger("[SPIDER AGENT]")
+
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+SYNC_TICK_SECONDS = Histogram('skx_sync_tick_seconds', 'duration of a job status sync tick')
+JOB_TRANSITIONS = Counter('skx_job_transitions_total', 'job execution state changes', ['status'])
 
 
 class SpiderServiceProxy(object):
     def __init__(self, server):
         # service machine id
         self._server = server
+        self.health = DaemonHealth(server)
 
     def get_project_list(self):
         '''
@@ -32,14 +57,22 @@ class SpiderServiceProxy(object):
         '''
         return NotImplementedError
 
-    def get_daemon_status(self):
+    def get_daemon_status(self, timeout=None, retry_times=HTTP_RETRY_TIMES):
+        '''
+
+        :param timeout: seconds
+        :param retry_times: attempts
+        :return: dict(running=, pending=, finished=), None if unavailable
+        '''
         return NotImplementedError
 
-    def get_job_list(self, project_name, spider_status):
+    def get_job_list(self, project_name, spider_status, timeout=None, retry_times=HTTP_RETRY_TIMES):
         '''
 
         :param project_name:
         :param spider_status:
+        :param timeout: seconds
+        :param retry_times: attempts
         :return: job service execution id list
         '''
         return NotImplementedError
@@ -70,6 +103,12 @@ class SpiderServiceProxy(object):
 class SpiderAgent():
     def __init__(self):
         self.spider_service_instances = []
+        self._sync_executor = ThreadPoolExecutor(max_workers=SYNC_MAX_WORKERS, thread_name_prefix='skx-sync')
+        # durations (seconds) of the latest status sync ticks
+        self.sync_tick_durations = deque(maxlen=100)
+        self.placement_policy = get_placement_policy(PLACEMENT_POLICY)
+        # server -> dict(running=, pending=), refreshed every sync tick and bumped on every launch
+        self.daemon_loads = {}
 
     def regist(self, spider_service_proxy):
         if isinstance(spider_service_proxy, SpiderServiceProxy):
@@ -91,42 +130,169 @@ class SpiderAgent():
         return spider_instance_list
 
     def get_daemon_status(self):
-        pass
+        return dict((server, dict(load)) for server, load in self.daemon_loads.items())
 
-    def sync_job_status(self, project):
-        for spider_service_instance in self.spider_service_instances:
-            job_status = spider_service_instance.get_job_list(project.project_name)
-            job_execution_list = JobExecution.list_uncomplete_job()
-            job_execution_dict = dict(
-                [(job_execution.service_job_execution_id, job_execution) for job_execution in job_execution_list])
+    def get_daemon_health(self):
+        return [spider_service_instance.health.to_dict() for spider_service_instance in self.spider_service_instances]
+
+    @property
+    def pollable_instances(self):
+        '''
+        daemons the sync polls, open breakers are skipped and half open ones probed
+        '''
+        return [spider_service_instance for spider_service_instance in self.spider_service_instances
+                if spider_service_instance.health.pollable]
+
+    @property
+    def healthy_instances(self):
+        return [spider_service_instance for spider_service_instance in self.spider_service_instances
+                if spider_service_instance.health.healthy]
+
+    def _poll_daemon_status(self):
+        # a single attempt each, a retried poll of a hung daemon would hold its sync worker into the next tick
+        futures = dict((self._sync_executor.submit(spider_service_instance.get_daemon_status,
+                                                   timeout=SYNC_REQUEST_TIMEOUT, retry_times=1),
+                        spider_service_instance.server)
+                       for spider_service_instance in self.pollable_instances)
+        done, not_done = wait(futures, timeout=SYNC_REQUEST_TIMEOUT * 2)
+        for future in not_done:
+            future.cancel()
+        result = {}
+        for future in done:
+            try:
+                result[futures[future]] = future.result()
+            except Exception as e:
+                logger.warning('poll daemon status error %s: %s' % (futures[future], e))
+        return result
+
+    def sync_daemon_status(self):
+        '''
+        refresh running/pending counts of every daemon from its daemonstatus
+        :return: servers refreshed
+        '''
+        refreshed = set()
+        for server, daemon_status in self._poll_daemon_status().items():
+            if daemon_status:
+                self.daemon_loads[server] = dict(running=daemon_status['running'], pending=daemon_status['pending'])
+                refreshed.add(server)
+        return refreshed
+
+    def max_proc(self, server):
+        return DAEMON_MAX_PROC.get(server, DAEMON_DEFAULT_MAX_PROC)
+
+    def free_slots(self, server):
+        '''
+        :param server:
+        :return: processes the daemon can start before queueing jobs as pending, None if unlimited
+        '''
+        max_proc = self.max_proc(server)
+        if not max_proc:
+            return None
+        return max_proc - daemon_load(self.daemon_loads, server)
+
+    def _poll_job_status(self, poll_pairs):
+        '''
+        poll listjobs of the given daemon/project pairs concurrently
+        :param poll_pairs: [(server, project_name)]
+        :return: {(server, project_name): job_status}, pairs which failed or timed out are left out
+        '''
+        spider_service_instance_dict = dict(
+            (spider_service_instance.server, spider_service_instance) for spider_service_instance in
+            self.pollable_instances)
+        futures = {}
+        for server, project_name in poll_pairs:
+            spider_service_instance = spider_service_instance_dict.get(server)
+            if not spider_service_instance:
+                continue
+            future = self._sync_executor.submit(spider_service_instance.get_job_list, project_name,
+                                                timeout=SYNC_REQUEST_TIMEOUT, retry_times=1)
+            futures[future] = (server, project_name)
+        if not futures:
+            return {}
+        # a single attempt bounded by the connect and read timeouts each, the wait bounds the whole fan-out
+        done, not_done = wait(futures, timeout=SYNC_REQUEST_TIMEOUT * 2)
+        for future in not_done:
+            future.cancel()
+            logger.warning('poll job status timeout %s %s' % futures[future])
+        result = {}
+        for future in done:
+            try:
+                result[futures[future]] = future.result()
+            except Exception as e:
+                logger.warning('poll job status error %s %s: %s' % (futures[future] + (e,)))
+        return result
+
+    def sync_all_job_status(self, project_list):
+        '''
+        sync running status of all projects in one tick.
+        uncompleted executions are loaded once and only the daemon/project pairs
+        running them are polled, concurrently, the results are applied in one transaction
+        :param project_list:
+        :return: tick duration in seconds
+        '''
+        start = time.time()
+        refreshed = self.sync_daemon_status()
+        project_name_dict = dict((project.id, project.project_name) for project in project_list)
+        job_execution_dict = {}
+        poll_pairs = set()
+        for job_execution in JobExecution.list_uncomplete_job():
+            project_name = project_name_dict.get(job_execution.project_id)
+            if not project_name:
+                continue
+            job_execution_dict[(job_execution.running_on, job_execution.service_job_execution_id)] = job_execution
+            poll_pairs.add((job_execution.running_on, project_name))
+        polls = self._poll_job_status(poll_pairs)
+        # daemons whose daemonstatus did not answer keep a load counted from the polled job lists
+        job_list_loads = {}
+        for (server, project_name), job_status in polls.items():
+            if server not in refreshed:
+                load = job_list_loads.setdefault(server, dict(running=0, pending=0))
+                load['running'] += len(job_status[SpiderStatus.RUNNING])
+                load['pending'] += len(job_status[SpiderStatus.PENDING])
+        self.daemon_loads.update(job_list_loads)
+        finished_job_executions = []
+        for (server, project_name), job_status in polls.items():
             # running
             for job_execution_info in job_status[SpiderStatus.RUNNING]:
-                job_execution = job_execution_dict.get(job_execution_info['id'])
+                job_execution = job_execution_dict.get((server, job_execution_info['id']))
                 if job_execution and job_execution.running_status == SpiderStatus.PENDING:
                     job_execution.start_time = job_execution_info['start_time']
                     job_execution.running_status = SpiderStatus.RUNNING
+                    JOB_TRANSITIONS.inc(status='running')
 
             # finished
             for job_execution_info in job_status[SpiderStatus.FINISHED]:
-                job_execution = job_execution_dict.get(job_execution_info['id'])
+                job_execution = job_execution_dict.get((server, job_execution_info['id']))
                 if job_execution and job_execution.running_status != SpiderStatus.FINISHED:
                     job_execution.start_time = job_execution_info['start_time']
                     job_execution.end_time = job_execution_info['end_time']
                     job_execution.running_status = SpiderStatus.FINISHED
-            # commit
-            session.commit()
-
-    def start_spider(self, job_instance):
-        project = Project.find_project_by_id(job_instance.project_id)
-        spider_name = job_instance.spider_name
-        #arguments = {}
-        #if job_instance.spider_arguments:
-        #    arguments = dict(map(lambda x: x.split("="), job_instance.spider_arguments.split(",")))
-        from collections import defaultdict
-        arguments = defaultdict(list)
-        if job_instance.spider_arguments:
-            for k, v in list(map(lambda x: x.split('=', 1), job_instance.spider_arguments.split(','))):
-                arguments[k].append(v)
+                    JOB_TRANSITIONS.inc(status='finished')
+                    if job_execution.job_instance:
+                        JobRunStats.record(job_execution, job_execution.job_instance.spider_name, success_count=1)
+                        finished_job_executions.append((server, project_name, job_execution))
+        # commit
+        session.commit()
+        if LOG_ARCHIVE_ENABLED:
+            spider_service_instance_dict = dict(
+                (spider_service_instance.server, spider_service_instance) for spider_service_instance in
+                self.spider_service_instances)
+            for server, project_name, job_execution in finished_job_executions:
+                log_archiver.submit(job_execution, spider_service_instance_dict[server].log_url(
+                    project_name, job_execution.job_instance.spider_name, job_execution.service_job_execution_id))
+        duration = time.time() - start
+        self.sync_tick_durations.append(duration)
+        SYNC_TICK_SECONDS.observe(duration)
+        return duration
+
+    def select_daemons(self, job_instance, available=None):
+        '''
+        daemons a job instance is launched on, the daemon argument wins over the placement policy
+        :param job_instance:
+        :param available: optional filter of daemons able to take a launch right now, applied to single
+        daemon launches only and ignored if none is. a fan out keeps its busy daemons, the caller waits on them
+        :return: [spider service instance]
+        '''
         threshold = 0
         daemon_size = len(self.spider_service_instances)
         if job_instance.priority == JobPriority.HIGH:
@@ -135,25 +301,61 @@ class SpiderAgent():
             threshold = int(daemon_size)
         threshold = 1 if threshold == 0 else threshold
         candidates = self.spider_service_instances
-        leaders = []
+        arguments = self.spider_arguments(job_instance)
         if 'daemon' in arguments:
             for candidate in candidates:
-                if candidate.server == arguments['daemon']:
-                    leaders = [candidate]
+                if candidate.server in arguments['daemon']:
+                    return [candidate]
+            return []
+        healthy_candidates = self.healthy_instances
+        if healthy_candidates:
+            candidates = healthy_candidates
         else:
-            # TODO optimize some better func to vote the leader
-            for i in range(threshold):
-                leaders.append(random.choice(candidates))
-        for leader in leaders:
-            serviec_job_id = leader.start_spider(project.project_name, spider_name, arguments)
-            job_execution = JobExecution()
-            job_execution.project_id = job_instance.project_id
-            job_execution.service_job_execution_id = serviec_job_id
-            job_execution.job_instance_id = job_instance.id
-            job_execution.create_time = datetime.datetime.now()
-            job_execution.running_on = leader.server
-            session.add(job_execution)
-            session.commit()
+            logger.warning('no healthy daemon, placing on all daemons')
+        if available and threshold == 1:
+            candidates = [candidate for candidate in candidates if available(candidate)] or candidates
+        return self.placement_policy.select(candidates, self.daemon_loads, job_instance, threshold)
+
+    @staticmethod
+    def spider_arguments(job_instance):
+        arguments = defaultdict(list)
+        if job_instance.spider_arguments:
+            for k, v in list(map(lambda x: x.split('=', 1), job_instance.spider_arguments.split(','))):
+                arguments[k].append(v)
+        return arguments
+
+    def launch(self, job_instance, leader, project=None):
+        '''
+        schedule the spider on one daemon and record the execution
+        :return: job execution, None if the daemon refused
+        '''
+        project = project or Project.find_project_by_id(job_instance.project_id)
+        serviec_job_id = leader.start_spider(project.project_name, job_instance.spider_name,
+                                             self.spider_arguments(job_instance))
+        if not serviec_job_id:
+            JOB_TRANSITIONS.inc(status='launch_failed')
+            logger.warning('launch %s of project %s on %s failed' % (job_instance.spider_name,
+                                                                     project.project_name, leader.server))
+            return None
+        # count the launch until the next daemon status refresh
+        load = self.daemon_loads.setdefault(leader.server, dict(running=0, pending=0))
+        load['pending'] += 1
+        job_execution = JobExecution()
+        job_execution.project_id = job_instance.project_id
+        job_execution.service_job_execution_id = serviec_job_id
+        job_execution.job_instance_id = job_instance.id
+        job_execution.create_time = datetime.datetime.now()
+        job_execution.running_on = leader.server
+        session.add(job_execution)
+        JobRunStats.record(job_execution, job_instance.spider_name, run_count=1)
+        session.commit()
+        JOB_TRANSITIONS.inc(status='pending')
+        return job_execution
+
+    def start_spider(self, job_instance):
+        project = Project.find_project_by_id(job_instance.project_id)
+        for leader in self.select_daemons(job_instance):
+            self.launch(job_instance, leader, project)
 
     def cancel_spider(self, job_execution):
         job_instance = JobInstance.find_job_instance_by_id(job_execution.job_instance_id)
@@ -163,14 +365,55 @@ class SpiderAgent():
                 if spider_service_instance.cancel_spider(project.project_name, job_execution.service_job_execution_id):
                     job_execution.end_time = datetime.datetime.now()
                     job_execution.running_status = SpiderStatus.CANCELED
+                    JobRunStats.record(job_execution, job_instance.spider_name, cancel_count=1)
                     session.commit()
+                    JOB_TRANSITIONS.inc(status='canceled')
                 break
 
-    def deploy(self, project, file_path):
+    def deploy(self, project, file_path, force=False, progress=None):
+        '''
+        upload the egg to every daemon concurrently, a daemon whose last successful deploy of the
+        project was the same egg is skipped unless forced
+        :param project:
+        :param file_path: egg
+        :param force: upload even if unchanged
+        :param progress: called with (daemons done, daemons) after every upload
+        :return: {server: dict(status=DeployStatus, message=)}
+        '''
+        egg_sha256 = file_sha256(file_path)
+        version = str(int(time.time()))
+        results = {}
+        targets = []
         for spider_service_instance in self.spider_service_instances:
-            if not spider_service_instance.deploy(project.project_name, file_path):
-                return False
-        return True
+            last_deploy = SpiderDeploy.last_deploy(project.id, spider_service_instance.server, DeployStatus.OK)
+            if not force and last_deploy and last_deploy.egg_sha256 == egg_sha256:
+                results[spider_service_instance.server] = dict(status=DeployStatus.UNCHANGED,
+                                                               message='version %s' % last_deploy.version)
+            else:
+                targets.append(spider_service_instance)
+        if targets:
+            with ThreadPoolExecutor(max_workers=min(len(targets), DEPLOY_MAX_WORKERS),
+                                    thread_name_prefix='skx-deploy') as executor:
+                futures = dict((executor.submit(spider_service_instance.deploy, project.project_name, file_path,
+                                                version), spider_service_instance.server)
+                               for spider_service_instance in targets)
+                for future in as_completed(futures):
+                    server = futures[future]
+                    try:
+                        ok, message = future.result()
+                    except Exception as e:
+                        ok, message = False, str(e)
+                    status = DeployStatus.OK if ok else DeployStatus.FAILED
+                    results[server] = dict(status=status, message=message)
+                    session.add(SpiderDeploy(project_id=project.id, server=server, version=version,
+                                             egg_sha256=egg_sha256, status=status, message=message))
+                    if progress:
+                        progress(len(results), len(self.spider_service_instances))
+            session.commit()
+        for server, result in results.items():
+            if result['status'] == DeployStatus.FAILED:
+                logger.warning('deploy %s to %s failed: %s' % (project.project_name, server, result['message']))
+        return results
 
     def log_url(self, job_execution):
         job_instance = JobInstance.find_job_instance_by_id(job_execution.job_instance_id)
@@ -186,5 +429,7 @@ class SpiderAgent():
                 self.spider_service_instances]
 
 
+agent = SpiderAgent()
+
 if __name__ == '__main__':
     pass
@@ -1,19 +1,53 @@
-import time
+import datetime
+import functools
+import logging
+import threading
 
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED
 from sqlalchemy import select
 from SpiderKeeperX.app import scheduler, agent
-from SpiderKeeperX.app.spider.model import Project, JobInstance, SpiderInstance, session
+from SpiderKeeperX.app.spider.model import Project, JobInstance, SpiderInstance, JobRunType, session, session_scope
+from SpiderKeeperX.app.proxy.dispatch import dispatcher
+from SpiderKeeperX.app.spider.retention import purge_job_executions
+from SpiderKeeperX.app.util import events
+from SpiderKeeperX.app.util.metrics import Counter, Histogram
+from SpiderKeeperX.config import SYNC_STATUS_INTERVAL, CRON_JITTER
 
+logger = logging.getLogger("[SCHEDULER]")
 
+SCHEDULER_LAG_SECONDS = Histogram('skx_scheduler_lag_seconds', 'delay between the scheduled and the actual run of a job',
+                                  ['job'])
+SCHEDULER_JOB_ERRORS = Counter('skx_scheduler_job_errors_total', 'scheduler jobs which raised', ['job'])
+SCHEDULER_JOB_MISSED = Counter('skx_scheduler_job_missed_total', 'scheduler runs skipped past the misfire grace time',
+                               ['job'])
+
+
+def scheduler_job(func):
+    '''
+    run a scheduler job in a session of its own which is closed when the job returns, so the
+    pooled connection is not left in an open transaction between runs
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with session_scope():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+@scheduler_job
 def sync_job_execution_status_job():
     '''
     sync job execution running status
     :return:
     '''
-    for project in session.execute(select(Project)).scalars():
-        agent.sync_job_status(project)
+    duration = agent.sync_all_job_status(list(session.execute(select(Project)).scalars()))
+    logger.debug('[sync_job_execution_status_job] tick took %.3fs' % duration)
+    if duration > SYNC_STATUS_INTERVAL:
+        logger.warning('[sync_job_execution_status_job] tick took %.3fs, longer than the %ss interval' % (
+            duration, SYNC_STATUS_INTERVAL))
 
 
+@scheduler_job
 def sync_spiders():
     '''
     sync spiders
@@ -21,59 +55,165 @@ def sync_spiders():
     '''
     for project in session.execute(select(Project)).scalars():
         spider_instance_list = agent.get_spider_list(project)
-        SpiderInstance.update_spider_instances(project.id, spider_instance_list)
+        if SpiderInstance.update_spider_instances(project.id, spider_instance_list):
+            events.publish(events.SPIDERS_CHANGED, project_id=project.id)
 
 
+@scheduler_job
+def purge_job_execution_job():
+    '''
+    archive and delete job executions past the retention policy
+    :return:
+    '''
+    for project in list(session.execute(select(Project)).scalars()):
+        try:
+            purge_job_executions(project)
+        except Exception as e:
+            logger.error('[purge_job_execution_job] project %s: %s' % (project.project_name, e))
+
+
+@scheduler_job
 def run_spider_job(job_instance_id):
     '''
-    run spider by scheduler
+    run spider by scheduler, the launch goes through the dispatch queue
     :param job_instance:
     :return:
     '''
     try:
         job_instance = JobInstance.find_job_instance_by_id(job_instance_id)
-        agent.start_spider(job_instance)
-        # app.logger.info('[run_spider_job][project:%s][spider_name:%s][job_instance_id:%s]' % (
-        #     job_instance.project_id, job_instance.spider_name, job_instance.id))
+        dispatcher.submit(job_instance)
+        logger.info('[run_spider_job][project:%s][spider_name:%s][job_instance_id:%s]' % (
+            job_instance.project_id, job_instance.spider_name, job_instance.id))
     except Exception as e:
-        # app.logger.error('[run_spider_job] ' + str(e))
-        ...
+        SCHEDULER_JOB_ERRORS.inc(job='spider_job')
+        logger.error('[run_spider_job][job_instance_id:%s] %s' % (job_instance_id, e))
+
+
+def spider_job_id(job_instance_id):
+    return 'spider_job_%s' % job_instance_id
+
+
+def spider_job_version(job_instance):
+    '''
+    kept as the name of the cron job, tells whether a stored job is still up to date after a restart
+    '''
+    return '%s@%s~%s' % (job_instance.id, job_instance.date_modified, CRON_JITTER)
+
 
+# job instance id -> date_modified of the scheduled version
+_scheduled_versions = {}
+_periodic_version = None
+_schedule_lock = threading.RLock()
 
+
+def _remove_spider_job(job_instance_id):
+    if scheduler.get_job(spider_job_id(job_instance_id), jobstore='spider'):
+        scheduler.remove_job(spider_job_id(job_instance_id), jobstore='spider')
+        return True
+    return False
+
+
+def unschedule_job_instance(job_instance_id):
+    with _schedule_lock:
+        _scheduled_versions.pop(job_instance_id, None)
+        if _remove_spider_job(job_instance_id):
+            logger.info('[unschedule_job_instance][job_instance_id:%s]' % job_instance_id)
+
+
+def schedule_job_instance(job_instance):
+    '''
+    add or replace the cron job of an enabled periodic job instance, remove it otherwise.
+    a stored job of the same version is left alone so its next run time survives restarts
+    :param job_instance:
+    :return:
+    '''
+    if job_instance.run_type != JobRunType.PERIODIC or job_instance.enabled != 0:
+        unschedule_job_instance(job_instance.id)
+        return
+    with _schedule_lock:
+        job = scheduler.get_job(spider_job_id(job_instance.id), jobstore='spider')
+        if job and job.name == spider_job_version(job_instance):
+            _scheduled_versions[job_instance.id] = job_instance.date_modified
+            return
+        try:
+            scheduler.add_job(run_spider_job,
+                              args=(job_instance.id,),
+                              trigger='cron',
+                              id=spider_job_id(job_instance.id),
+                              name=spider_job_version(job_instance),
+                              minute=job_instance.cron_minutes,
+                              hour=job_instance.cron_hour,
+                              day=job_instance.cron_day_of_month,
+                              day_of_week=job_instance.cron_day_of_week,
+                              month=job_instance.cron_month,
+                              second=0,
+                              jitter=CRON_JITTER or None,
+                              max_instances=999,
+                              misfire_grace_time=60 * 60,
+                              coalesce=True,
+                              jobstore='spider',
+                              replace_existing=True)
+        except Exception as e:
+            # keep the version so a bad cron expression is not retried on every reconciliation
+            _remove_spider_job(job_instance.id)
+            _scheduled_versions[job_instance.id] = job_instance.date_modified
+            logger.error('[schedule_job_instance] job_instance_id %s, may be cron expression format error: %s' % (
+                job_instance.id, e))
+            return
+        _scheduled_versions[job_instance.id] = job_instance.date_modified
+    logger.info('[schedule_job_instance][project:%s][spider_name:%s][job_instance_id:%s]' % (
+        job_instance.project_id, job_instance.spider_name, job_instance.id))
+
+
+def on_job_instance_changed(job_instance_id):
+    '''
+    apply one job instance change published by the controllers
+    '''
+    job_instance = session.get(JobInstance, int(job_instance_id), populate_existing=True)
+    if job_instance:
+        schedule_job_instance(job_instance)
+    else:
+        unschedule_job_instance(int(job_instance_id))
+
+
+@scheduler_job
 def reload_runnable_spider_job_execution():
     '''
-    add periodic job to scheduler
+    reconcile the periodic jobs of the scheduler with the database, changes normally arrive as events,
+    this is a single aggregate query unless something changed behind our back
     :return:
     '''
-    running_job_ids = set([job.id for job in scheduler.get_jobs()])
-    # app.logger.debug('[running_job_ids] %s' % ','.join(running_job_ids))
-    available_job_ids = set()
-    # add new job to schedule
-    for job_instance in session.execute(select(JobInstance).filter_by(enabled=0, run_type="periodic")).scalars():
-        job_id = "spider_job_{:s}:{:s}".format(job_instance.id, int(time.mktime(job_instance.date_modified.timetuple())))
-        available_job_ids.add(job_id)
-        if job_id not in running_job_ids:
-            try:
-                scheduler.add_job(run_spider_job,
-                                    args=(job_instance.id,),
-                                    trigger='cron',
-                                    id=job_id,
-                                    minute=job_instance.cron_minutes,
-                                    hour=job_instance.cron_hour,
-                                    day=job_instance.cron_day_of_month,
-                                    day_of_week=job_instance.cron_day_of_week,
-                                    month=job_instance.cron_month,
-                                    second=0,
-                                    max_instances=999,
-                                    misfire_grace_time=60 * 60,
-                                    coalesce=True)
-            except Exception as e:
-                ...
-                # app.logger.error(
-                #     '[load_spider_job] failed {} {},may be cron expression format error '.format(job_id, str(e)))
-            # app.logger.info('[load_spider_job][project:%s][spider_name:%s][job_instance_id:%s][job_id:%s]' % (
-            #     job_instance.project_id, job_instance.spider_name, job_instance.id, job_id))
-    # remove invalid jobs
-    for invalid_job_id in filter(lambda job_id: job_id.startswith("spider_job_"), running_job_ids.difference(available_job_ids)):
-        scheduler.remove_job(invalid_job_id)
-        #app.logger.info('[drop_spider_job][job_id:%s]' % invalid_job_id)
+    global _periodic_version
+    version = JobInstance.periodic_version()
+    with _schedule_lock:
+        if version == _periodic_version:
+            return
+        available_ids = set()
+        for job_instance in session.execute(select(JobInstance).filter_by(enabled=0, run_type=JobRunType.PERIODIC)).scalars():
+            available_ids.add(job_instance.id)
+            if _scheduled_versions.get(job_instance.id) != job_instance.date_modified:
+                schedule_job_instance(job_instance)
+        # jobs stored by an earlier run may belong to instances removed while we were down
+        stored_ids = set(job.args[0] for job in scheduler.get_jobs(jobstore='spider'))
+        for job_instance_id in set(_scheduled_versions).union(stored_ids).difference(available_ids):
+            unschedule_job_instance(job_instance_id)
+        _periodic_version = version
+
+
+def observe_scheduler_event(event):
+    '''
+    scheduler listener feeding the lag, error and misfire metrics
+    '''
+    if not getattr(event, 'job_id', None):
+        return
+    # spider cron jobs are one label, their count is unbounded
+    job = 'spider_job' if event.job_id.startswith('spider_job_') else event.job_id
+    if event.code == EVENT_JOB_SUBMITTED:
+        for scheduled_run_time in event.scheduled_run_times:
+            SCHEDULER_LAG_SECONDS.observe(
+                (datetime.datetime.now(scheduled_run_time.tzinfo) - scheduled_run_time).total_seconds(), job=job)
+    elif event.code == EVENT_JOB_ERROR:
+        SCHEDULER_JOB_ERRORS.inc(job=job)
+        logger.error('[%s] %s' % (event.job_id, event.exception))
+    elif event.code == EVENT_JOB_MISSED:
+        SCHEDULER_JOB_MISSED.inc(job=job)
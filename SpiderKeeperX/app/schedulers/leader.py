@@ -0,0 +1,72 @@
+import logging
+import threading
+
+from SpiderKeeperX.app.spider.model import SchedulerLease, session
+from SpiderKeeperX.config import LEADER_LEASE_NAME, LEADER_LEASE_SECONDS, LEADER_RENEW_INTERVAL
+
+logger = logging.getLogger("[LEADER]")
+
+
+class LeaderElector(object):
+    '''
+    keeps trying to hold the scheduler lease, calls on_elected when this instance becomes
+    the leader and on_demoted when it loses the lease. a dead leader is replaced once its
+    lease expires, so failover takes at most LEADER_LEASE_SECONDS + LEADER_RENEW_INTERVAL
+    '''
+
+    def __init__(self, holder, on_elected, on_demoted, name=LEADER_LEASE_NAME, ttl=LEADER_LEASE_SECONDS,
+                 interval=LEADER_RENEW_INTERVAL):
+        self.holder = holder
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.name = name
+        self.ttl = ttl
+        self.interval = interval
+        self.is_leader = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def tick(self):
+        '''
+        renew or take the lease once
+        :return: whether this instance is the leader
+        '''
+        try:
+            leader = SchedulerLease.acquire(self.name, self.holder, self.ttl)
+        except Exception as e:
+            # a leader that can not reach the database must assume someone else took over
+            logger.error('lease renewal failed: %s' % e)
+            session.rollback()
+            leader = False
+        if leader and not self.is_leader:
+            logger.info('%s is now the leader' % self.holder)
+            self.is_leader = True
+            self.on_elected()
+        elif not leader and self.is_leader:
+            logger.warning('%s lost the leadership' % self.holder)
+            self.is_leader = False
+            self.on_demoted()
+        return self.is_leader
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.tick()
+        session.remove()
+
+    def start(self):
+        self.tick()
+        self._thread = threading.Thread(target=self._run, name='skx-leader', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        stop renewing and release the lease so another instance takes over at once
+        '''
+        self._stopped.set()
+        if self.is_leader:
+            self.is_leader = False
+            self.on_demoted()
+            try:
+                SchedulerLease.release(self.name, self.holder)
+            except Exception as e:
+                logger.error('lease release failed: %s' % e)
@@ -1,22 +1,31 @@
 import os
-import tempfile
-import subprocess
+import json
+import asyncio
+import shutil
+import uuid
 import datetime
 
-import requests
-from fastapi.responses import RedirectResponse
-from fastapi import APIRouter, Request, Form, Header, UploadFile
+from fastapi.responses import RedirectResponse, StreamingResponse, PlainTextResponse
+from fastapi import APIRouter, Request, Form, Header, UploadFile, HTTPException, Depends
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 
 from werkzeug.utils import secure_filename
-from git import Repo
-from os import path
 
-from SpiderKeeperX.app.spider.model import JobInstance, Project, JobExecution, SpiderInstance, JobRunType, session
+from SpiderKeeperX.app.spider.model import JobInstance, Project, JobExecution, SpiderInstance, JobRunType, \
+    SpiderStatus, SpiderDeploy, BackgroundTask, AsyncSessionLocal, session, get_session
 from sqlalchemy import select
-from SpiderKeeperX.app.proxy.spiderctrl import SpiderAgent
-
-agent = SpiderAgent()
+from sqlalchemy.orm import Session
+from SpiderKeeperX.app.proxy.spiderctrl import agent
+from SpiderKeeperX.app.util.http import request_stream
+from SpiderKeeperX.app.util.logarchive import log_archiver, log_ref
+from SpiderKeeperX.app.util.tasks import task_runner
+from SpiderKeeperX.app.util.navigation import navigation
+from SpiderKeeperX.app.util import events, metrics, tasks
+from SpiderKeeperX.config import LOG_TAIL_KB, LOG_FOLLOW_INTERVAL, LOG_STREAM_CHUNK_SIZE, TASK_UPLOAD_DIR, \
+    LOG_ARCHIVE_ENABLED
+
+LOG_FOLLOW_READ_SIZE = 16 * LOG_STREAM_CHUNK_SIZE
 
 '''
 ======= Context Processor
@@ -27,19 +36,12 @@ def inject_common(request):
                 servers=agent.servers)
 
 def inject_project(request):
-    _session = {}
-    project_context = {}
-    project_context['project_list'] = session.execute(select(Project)).all()
-    if project_context['project_list'] and (not _session.get('project_id')):
-        project = session.execute(select(Project)).first()
-        _session['project_id'] = project.id
-    if _session.get('project_id'):
-        project_context['project'] = Project.find_project_by_id(_session['project_id'])
-        project_context['spider_list'] = [spider_instance.to_dict() for spider_instance in
-                        session.query(SpiderInstance).where(SpiderInstance.project_id==_session['project_id']).all()]
-    else:
-        project_context['project'] = {}
-    return project_context
+    # navigation of the project in the path, served from the navigation cache
+    try:
+        project_id = int(request.path_params.get('project_id'))
+    except (TypeError, ValueError):
+        project_id = None
+    return navigation.context(project_id)
 
 def utility_processor(request):
     def timedelta(end_time, start_time):
@@ -86,31 +88,34 @@ templates = Jinja2Templates(
 api_router = APIRouter()
 
 @api_router.get("/")
-def index():
-    project = session.execute(select(Project)).first()
+def index(db: Session = Depends(get_session)):
+    project = db.execute(select(Project)).scalars().first()
     if project:
-        return RedirectResponse(url=f"/project/{project.id}/job/dashboard", code=302)
+        return RedirectResponse(url=f"/project/{project.id}/job/dashboard", status_code=302)
     return RedirectResponse(url="/project/manage", status_code=302)
 
 @api_router.post("/project/create")
-def project_create(project_name: str = Form()):
+def project_create(project_name: str = Form(), db: Session = Depends(get_session)):
     project = Project()
     project.project_name = project_name
-    session.add(project)
-    session.commit()
+    db.add(project)
+    db.commit()
+    events.publish(events.PROJECT_CHANGED, project_id=project.id)
     return RedirectResponse(url=f"/project/{project.id}/spider/deploy", status_code=302)
 
 @api_router.get("/project/{project_id}/delete")
-def project_delete(project_id):
+def project_delete(project_id, db: Session = Depends(get_session)):
     project = Project.find_project_by_id(project_id)
     agent.delete_project(project)
-    session.delete(project)
-    session.commit()
+    deleted_project_id = project.id
+    db.delete(project)
+    db.commit()
+    events.publish(events.PROJECT_CHANGED, project_id=deleted_project_id)
     return RedirectResponse(url="/project/manage", status_code=302)
 
 @api_router.get("/project/manage")
 def project_manage(request: Request):
-    return templates.TemplateResponse("project_manage.html", {"request": request})
+    return templates.TemplateResponse(request, "project_manage.html", {})
 
 @api_router.get("/project/{project_id}")
 def project_index(project_id: int):
@@ -118,14 +123,14 @@ def project_index(project_id: int):
 
 @api_router.get("/project/{project_id}/job/dashboard")
 def job_dashboard(request: Request, project_id):
-    return templates.TemplateResponse("job_dashboard.html", {"request": request, "job_status": JobExecution.list_jobs(project_id)})
+    return templates.TemplateResponse(request, "job_dashboard.html", {"job_status": JobExecution.list_jobs(project_id)})
 
 @api_router.get("/project/{project_id}/job/periodic")
-def job_periodic(request: Request, project_id):
+def job_periodic(request: Request, project_id, db: Session = Depends(get_session)):
     project = Project.find_project_by_id(project_id)
     job_instance_list = [job_instance.to_dict() for job_instance in
-                         session.execute(select(JobInstance).filter_by(run_type="periodic", project_id=project_id)).scalars()]
-    return templates.TemplateResponse("job_periodic.html", {"request": request, "job_instance_list": job_instance_list})
+                         db.execute(select(JobInstance).filter_by(run_type="periodic", project_id=project_id)).scalars()]
+    return templates.TemplateResponse(request, "job_periodic.html", {"job_instance_list": job_instance_list})
 
 @api_router.post("/project/{project_id}/job/add")
 def job_add(project_id,
@@ -140,7 +145,8 @@ def job_add(project_id,
             cron_day_of_week: str = Form(),
             cron_month: str = Form(),
             cron_exp: str = Form(),
-            referrer: str = Header()
+            referrer: str = Header(),
+            db: Session = Depends(get_session)
             ):
     project = Project.find_project_by_id(project_id)
     job_instance = JobInstance()
@@ -158,8 +164,8 @@ def job_add(project_id,
         job_instance.spider_arguments = ','.join(spider_args)
     if job_instance.run_type == JobRunType.ONETIME:
         job_instance.enabled = -1
-        session.add(job_instance)
-        session.commit()
+        db.add(job_instance)
+        db.commit()
         agent.start_spider(job_instance)
     if job_instance.run_type == JobRunType.PERIODIC:
         job_instance.cron_minutes = cron_minutes or '0'
@@ -171,94 +177,354 @@ def job_add(project_id,
         if cron_exp:
             job_instance.cron_minutes, job_instance.cron_hour, job_instance.cron_day_of_month, job_instance.cron_day_of_week, job_instance.cron_month = \
                 cron_exp.split(' ')
-        session.add(job_instance)
-        session.commit()
+        db.add(job_instance)
+        db.commit()
+        events.publish(events.JOB_INSTANCE_CHANGED, job_instance_id=job_instance.id)
     return RedirectResponse(url=referrer, status_code=302)
 
 @api_router.get("/project/{project_id}/jobexecs/{job_exec_id}/stop")
 def job_stop(project_id, job_exec_id, referrer: str = Header()):
-    job_execution = JobExecution.query.filter_by(project_id=project_id, id=job_exec_id).first()
+    job_execution = JobExecution.find_job_execution(project_id, job_exec_id)
+    if not job_execution:
+        raise HTTPException(status_code=404)
     agent.cancel_spider(job_execution)
     return RedirectResponse(url=referrer, status_code=302)
 
 @api_router.get("/project/{project_id}/jobexecs/{job_exec_id}/log")
-def job_log(request: Request ,project_id, job_exec_id):
-    job_execution = JobExecution.query.filter_by(project_id=project_id, id=job_exec_id).first()
-    res = requests.get(agent.log_url(job_execution))
-    res.encoding = 'utf8'
-    raw = res.text
-    return templates.TemplateResponse("job_log.html", {"request": request, "log_lines":raw.split('\n')})
+def job_log(request: Request, project_id, job_exec_id):
+    job_execution = JobExecution.find_job_execution(project_id, job_exec_id)
+    if not job_execution:
+        raise HTTPException(status_code=404)
+    if log_archiver.is_archived(job_execution):
+        raw, log_truncated = log_archiver.read_tail(job_execution, LOG_TAIL_KB * 1024)
+        return _render_log(request, raw, log_truncated)
+    # only the tail is fetched, the full log is served by the raw endpoint
+    res = request_stream(agent.log_url(job_execution), headers={'Range': 'bytes=-%d' % (LOG_TAIL_KB * 1024)})
+    if res is None:
+        raise HTTPException(status_code=502, detail='log unavailable')
+    if res.status_code == 206:
+        with res:
+            raw = res.raw.read(LOG_TAIL_KB * 1024, decode_content=True)
+        log_truncated = not res.headers.get('Content-Range', '').startswith('bytes 0-')
+    elif res.ok:
+        raw, log_truncated = _read_tail(res, LOG_TAIL_KB * 1024)
+    else:
+        res.close()
+        raw, log_truncated = b'', False
+    return _render_log(request, raw, log_truncated)
+
+def _read_tail(res, size):
+    '''
+    last size bytes of a daemon that ignored the range and sent the whole log
+    :return: (tail, True if the log was longer)
+    '''
+    tail, total = b'', 0
+    with res:
+        for chunk in res.iter_content(LOG_STREAM_CHUNK_SIZE):
+            total += len(chunk)
+            tail = (tail + chunk)[-size:]
+    return tail, total > size
+
+def _render_log(request, raw, log_truncated):
+    log_lines = raw.decode('utf8', errors='replace').split('\n')
+    if log_truncated:
+        # the first line was cut by the range
+        log_lines = log_lines[1:]
+    return templates.TemplateResponse(request, "job_log.html", {"log_lines": log_lines,
+                                                       "log_truncated": log_truncated, "log_tail_kb": LOG_TAIL_KB,
+                                                       "log_raw_url": request.url.path + '/raw'})
+
+def _parse_content_range(res):
+    '''
+    :param res:
+    :return: (first byte offset, total size or None) of a 206 response
+    '''
+    unit_range, _, total = res.headers.get('Content-Range', '').partition('/')
+    first = unit_range.replace('bytes', '').strip().split('-')[0]
+    return int(first or 0), int(total) if total.isdigit() else None
+
+def _stream_log(res, skip=0):
+    '''
+    :param res: streamed response of the daemon
+    :param skip: bytes to drop, when the daemon ignored the range
+    '''
+    with res:
+        for chunk in res.iter_content(LOG_STREAM_CHUNK_SIZE):
+            if skip:
+                chunk, skip = chunk[skip:], max(0, skip - len(chunk))
+            if chunk:
+                yield chunk
+
+def _read_log_from(log_url, offset):
+    '''
+    :return: at most LOG_FOLLOW_READ_SIZE bytes of the log from offset, b'' when none is there yet
+    '''
+    res = request_stream(log_url, headers={'Range': 'bytes=%d-%d' % (offset, offset + LOG_FOLLOW_READ_SIZE - 1)})
+    if res is None:
+        return b''
+    with res:
+        if res.status_code == 206:
+            return res.raw.read(LOG_FOLLOW_READ_SIZE, decode_content=True)
+        if res.status_code == 200:
+            # the daemon ignored the range
+            data = b''
+            for chunk in _stream_log(res, offset):
+                data += chunk
+                if len(data) >= LOG_FOLLOW_READ_SIZE:
+                    break
+            return data[:LOG_FOLLOW_READ_SIZE]
+    return b''
+
+def _job_execution_completed(job_execution_id):
+    job_execution = session.get(JobExecution, job_execution_id, populate_existing=True)
+    return not job_execution or job_execution.running_status in (SpiderStatus.FINISHED, SpiderStatus.CANCELED)
+
+async def _follow_log(log_url, job_execution_id, offset):
+    '''
+    server sent events of the lines appended to the log, the event id is the byte offset after
+    the event so a reconnecting client resumes from Last-Event-ID. ends when the execution
+    is completed and no more bytes come. waits on the event loop so a follower holds no thread
+    '''
+    pending = b''
+    while True:
+        data = await run_in_threadpool(_read_log_from, log_url, offset)
+        if data:
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            offset += len(data)
+            if lines:
+                yield 'id: %d\n%s\n\n' % (offset - len(pending), '\n'.join(
+                    'data: ' + line.decode('utf8', errors='replace') for line in lines))
+            continue
+        if await run_in_threadpool(_job_execution_completed, job_execution_id):
+            if pending:
+                yield 'id: %d\ndata: %s\n\n' % (offset, pending.decode('utf8', errors='replace'))
+            yield 'event: end\ndata: \n\n'
+            return
+        await asyncio.sleep(LOG_FOLLOW_INTERVAL)
+
+@api_router.get("/project/{project_id}/jobexecs/{job_exec_id}/log/raw")
+def job_log_raw(project_id, job_exec_id, offset: int = None, tail: int = None, follow: bool = False,
+                range_header: str = Header(None, alias='Range'), last_event_id: str = Header(None)):
+    '''
+    the daemon log streamed as is.
+    offset: bytes to skip, tail: KB from the end, follow: server sent events of appended lines.
+    a Range header is passed through to the daemon
+    '''
+    job_execution = JobExecution.find_job_execution(project_id, job_exec_id)
+    if not job_execution:
+        raise HTTPException(status_code=404)
+    if not follow and not range_header and log_archiver.is_archived(job_execution):
+        if tail:
+            raw, _ = log_archiver.read_tail(job_execution, tail * 1024)
+            return StreamingResponse(iter([raw]), media_type='text/plain; charset=utf-8')
+        return StreamingResponse(log_archiver.iter_log(job_execution, offset or 0),
+                                 media_type='text/plain; charset=utf-8')
+    log_url = agent.log_url(job_execution)
+    if follow:
+        start = int(last_event_id) if last_event_id and last_event_id.isdigit() else offset
+        if start is None:
+            # follow starts from the tail like tail -f
+            res = request_stream(log_url, headers={'Range': 'bytes=-%d' % ((tail or LOG_TAIL_KB) * 1024)})
+            start = _parse_content_range(res)[0] if res is not None and res.status_code == 206 else 0
+            if res is not None:
+                res.close()
+        return StreamingResponse(_follow_log(log_url, job_execution.id, start), media_type="text/event-stream",
+                                 headers={'Cache-Control': 'no-cache'})
+    if tail:
+        range_header = 'bytes=-%d' % (tail * 1024)
+    elif offset:
+        range_header = 'bytes=%d-' % offset
+    res = request_stream(log_url, headers={'Range': range_header} if range_header else None)
+    if res is None:
+        raise HTTPException(status_code=502, detail='log unavailable')
+    if res.status_code not in (200, 206):
+        res.close()
+        raise HTTPException(status_code=404 if res.status_code == 416 else 502)
+    headers = {'Accept-Ranges': 'bytes'}
+    skip = 0
+    if res.status_code == 206:
+        headers['Content-Range'] = res.headers['Content-Range']
+    elif offset and not tail:
+        skip = offset
+    if 'Content-Length' in res.headers and 'Content-Encoding' not in res.headers and not skip:
+        headers['Content-Length'] = res.headers['Content-Length']
+    return StreamingResponse(_stream_log(res, skip), status_code=res.status_code, headers=headers,
+                             media_type='text/plain; charset=utf-8')
 
 @api_router.get("/project/{project_id}/job/{job_instance_id}/run")
-def job_run(project_id, job_instance_id, referrer: str = Header()):
-    job_instance = JobInstance.query.filter_by(project_id=project_id, id=job_instance_id).first()
+def job_run(project_id, job_instance_id, referrer: str = Header(), db: Session = Depends(get_session)):
+    job_instance = db.execute(select(JobInstance).filter_by(project_id=project_id, id=job_instance_id)).scalar_one_or_none()
+    if not job_instance:
+        raise HTTPException(status_code=404)
     agent.start_spider(job_instance)
     return RedirectResponse(url=referrer, status_code=302)
 
 @api_router.get("/project/{project_id}/job/{job_instance_id}/remove")
-def job_remove(project_id, job_instance_id, referrer: str = Header()):
-    job_instance = JobInstance.query.filter_by(project_id=project_id, id=job_instance_id).first()
-    session.delete(job_instance)
-    session.commit()
+def job_remove(project_id, job_instance_id, referrer: str = Header(), db: Session = Depends(get_session)):
+    job_instance = db.execute(select(JobInstance).filter_by(project_id=project_id, id=job_instance_id)).scalar_one_or_none()
+    if not job_instance:
+        raise HTTPException(status_code=404)
+    db.delete(job_instance)
+    db.commit()
+    events.publish(events.JOB_INSTANCE_CHANGED, job_instance_id=job_instance_id)
     return RedirectResponse(url=referrer, status_code=302)
 
 @api_router.get("/project/{project_id}/job/{job_instance_id}/switch")
-def job_switch(project_id, job_instance_id, referrer: str = Header()):
-    job_instance = JobInstance.query.filter_by(project_id=project_id, id=job_instance_id).first()
+def job_switch(project_id, job_instance_id, referrer: str = Header(), db: Session = Depends(get_session)):
+    job_instance = db.execute(select(JobInstance).filter_by(project_id=project_id, id=job_instance_id)).scalar_one_or_none()
+    if not job_instance:
+        raise HTTPException(status_code=404)
     job_instance.enabled = -1 if job_instance.enabled == 0 else 0
-    session.commit()
+    db.commit()
+    events.publish(events.JOB_INSTANCE_CHANGED, job_instance_id=job_instance.id)
     return RedirectResponse(url=referrer, status_code=302)
 
 @api_router.get("/project/{project_id}/spider/dashboard")
 def spider_dashboard(request: Request, project_id):
     spider_instance_list = SpiderInstance.list_spiders(project_id)
-    return templates.TemplateResponse("spider_dashboard.html", {"request": request, "spider_instance_list": spider_instance_list})
+    return templates.TemplateResponse(request, "spider_dashboard.html", {"spider_instance_list": spider_instance_list})
 
 @api_router.get("/project/{project_id}/spider/deploy")
 def spider_deploy(request: Request, project_id):
     project = Project.find_project_by_id(project_id)
-    return templates.TemplateResponse("spider_deploy.html", {"request": request})
+    return templates.TemplateResponse(request, "spider_deploy.html", {})
 
 @api_router.post("/project/{project_id}/spider/upload")
-def spider_egg_upload(project_id, file: UploadFile, referrer: str = Header()):
+def spider_egg_upload(project_id, file: UploadFile, referrer: str = Header(), force: bool = Form(False)):
     project = Project.find_project_by_id(project_id)
     # if user does not select file, browser also
     # submit a empty part without filename
     if file.filename == '':
         return RedirectResponse(url=referrer)
     if file:
-        filename = secure_filename(file.filename)
-        dst = os.path.join(tempfile.gettempdir(), filename)
-        file.save(dst)
-        agent.deploy(project, dst)
+        filename = secure_filename(file.filename) or 'upload.egg'
+        os.makedirs(TASK_UPLOAD_DIR, exist_ok=True)
+        # kept until the deploy task is done with it
+        dst = os.path.join(TASK_UPLOAD_DIR, '%s_%s' % (uuid.uuid4().hex, filename))
+        with open(dst, 'wb') as f:
+            shutil.copyfileobj(file.file, f, LOG_STREAM_CHUNK_SIZE)
+        task_runner.submit(project.id, tasks.DEPLOY, file_path=dst, force=force)
     return RedirectResponse(referrer)
 
 @api_router.post("/project/{project_id}/spider/sync")
-async def spider_git_sync(project_id, request: Request, referrer: str = Header()):
-    project = Project.find_project_by_id(project_id)
-    form = await request.form()
-    if form['project-git-uri'].strip() == '':
+def spider_git_sync(project_id: int, referrer: str = Header(), git_uri: str = Form('', alias='project-git-uri'),
+                    git_folder: str = Form('', alias='project-git-uri-name')):
+    if git_uri.strip() == '':
         return RedirectResponse(url=referrer)
-    git_uri = form['project-git-uri'].strip()
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        Repo.clone_from(git_uri, tmp_dir)
-        # TODO
-        git_project_name = form['project-git-uri-name']
-        git_project_root = path.join(tmp_dir, git_project_name)
-        p = subprocess.Popen(["scrapyd-deploy", "--build-egg", f"{git_project_name}.egg", "include-dependencies"], cwd=git_project_root)
-        p.wait()
-        git_egg_path = path.join(git_project_root, f"{git_project_name}.egg")
-        agent.deploy(project, git_egg_path)
+    # clone, build and deploy run in the task runner, the request only queues them
+    task_runner.submit(project_id, tasks.GIT_SYNC, git_uri=git_uri.strip(), git_folder=git_folder)
     return RedirectResponse(referrer)
 
 @api_router.get("/project/{project_id}/project/stats")
 def project_stats(request: Request, project_id):
     project = Project.find_project_by_id(project_id)
     run_stats = JobExecution.list_run_stats_by_hours(project_id)
-    return templates.TemplateResponse("project_stats.html", {"request": request, "run_stats": run_stats})
+    return templates.TemplateResponse(request, "project_stats.html", {"run_stats": run_stats})
 
 @api_router.get("/project/{project_id}/server/stats")
 def service_stats(request: Request, project_id):
     project = Project.find_project_by_id(project_id)
     run_stats = JobExecution.list_run_stats_by_hours(project_id)
-    return templates.TemplateResponse("project_stats.html", {"request": request, "run_stats": run_stats})
+    return templates.TemplateResponse(request, "project_stats.html", {"run_stats": run_stats})
+
+
+'''
+========= Json Api =========
+'''
+
+JOB_EXECUTION_PAGE_MAX_LIMIT = 1000
+
+def _job_execution_item(job_execution):
+    item = job_execution.to_dict()
+    item['date_modified'] = job_execution.date_modified.strftime('%Y-%m-%d %H:%M:%S')
+    return item
+
+def _job_executions_page_tail(count, last_job_execution, limit):
+    next_cursor = JobExecution.encode_cursor(last_job_execution) if count == limit else None
+    return '], "next_cursor": %s}' % json.dumps(next_cursor)
+
+def _stream_job_executions(query, limit):
+    # iterated in worker threads with the session of the request
+    yield '{"items": ['
+    count, last_job_execution = 0, None
+    for job_execution in session.execute(query).scalars():
+        yield (',' if count else '') + json.dumps(_job_execution_item(job_execution))
+        count, last_job_execution = count + 1, job_execution
+    yield _job_executions_page_tail(count, last_job_execution, limit)
+
+async def _stream_job_executions_async(query, limit):
+    yield '{"items": ['
+    count, last_job_execution = 0, None
+    async with AsyncSessionLocal() as db:
+        async for job_execution in await db.stream_scalars(query):
+            yield (',' if count else '') + json.dumps(_job_execution_item(job_execution))
+            count, last_job_execution = count + 1, job_execution
+    yield _job_executions_page_tail(count, last_job_execution, limit)
+
+@api_router.get("/api/project/{project_id}/jobexecs")
+async def api_job_executions(project_id: int,
+                             cursor: str = None,
+                             limit: int = 100,
+                             status: int = None,
+                             spider_name: str = None,
+                             daemon: str = None,
+                             since: datetime.datetime = None,
+                             until: datetime.datetime = None):
+    limit = max(1, min(limit, JOB_EXECUTION_PAGE_MAX_LIMIT))
+    try:
+        query = JobExecution.jobs_page_query(project_id, cursor=cursor, limit=limit, running_status=status,
+                                             spider_name=spider_name, running_on=daemon, since=since, until=until)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if AsyncSessionLocal:
+        return StreamingResponse(_stream_job_executions_async(query, limit), media_type="application/json")
+    return StreamingResponse(_stream_job_executions(query, limit), media_type="application/json")
+
+@api_router.get("/api/daemons")
+def api_daemons():
+    daemon_loads = agent.get_daemon_status()
+    return {"items": [dict(daemon_health, load=daemon_loads.get(daemon_health['server']))
+                      for daemon_health in agent.get_daemon_health()]}
+
+@api_router.get("/api/project/{project_id}/deploys")
+def api_deploys(project_id: int):
+    '''
+    latest egg deploy of the project on every daemon
+    '''
+    return {"items": [spider_deploy.to_dict() for spider_deploy in SpiderDeploy.list_latest(project_id)]}
+
+@api_router.get("/api/project/{project_id}/tasks")
+def api_tasks(project_id: int, limit: int = 20):
+    '''
+    latest deploy and git sync tasks of the project
+    '''
+    return {"items": [task.to_dict() for task in BackgroundTask.list_by_project(project_id, max(1, min(limit, 100)))]}
+
+@api_router.get("/api/tasks/{task_id}")
+def api_task(task_id: int):
+    task = session.get(BackgroundTask, task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail='task %s not found' % task_id)
+    return task.to_dict()
+
+@api_router.get("/api/logs/search")
+def api_log_search(q: str, project_id: int = None, limit: int = 100):
+    '''
+    full text search over archived logs, q is a sqlite fts5 match expression
+    '''
+    if not LOG_ARCHIVE_ENABLED:
+        raise HTTPException(status_code=404, detail='log archive is disabled, see LOG_ARCHIVE_ENABLED')
+    try:
+        items = log_archiver.search(q, project_id=project_id, limit=max(1, min(limit, 1000)))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # lines archived for an execution of another database that had the same id are left out
+    job_executions = dict((job_execution.id, job_execution) for job_execution in session.execute(
+        select(JobExecution).filter(JobExecution.id.in_(set(item['job_execution_id'] for item in items)))).scalars())
+    return {"items": [item for item in items if item['job_execution_id'] in job_executions and
+                      log_ref(job_executions[item['job_execution_id']])[2] == item.pop('log_key')]}
+
+@api_router.get("/metrics")
+def metrics_export():
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,68 @@
+import logging
+
+from sqlalchemy import Column, INTEGER, String, inspect, select
+
+from SpiderKeeperX.app.spider.model import Base, JobExecution, JobRunStats, engine
+
+logger = logging.getLogger("[MIGRATION]")
+
+
+class SchemaVersion(Base):
+    __tablename__ = 'skx_schema_version'
+
+    version = Column(INTEGER, nullable=False)
+    description = Column(String(200))
+
+
+def _create_index(table, index_name):
+    def migrate(connection):
+        for index in table.indexes:
+            if index.name == index_name:
+                index.create(connection, checkfirst=True)
+    return migrate
+
+
+def _rebuild_run_stats(connection):
+    if connection.execute(select(JobExecution.id).limit(1)).first() is not None:
+        JobRunStats.rebuild(connection)
+
+
+# (version, description, migrate(connection)), append only. a migration must be safe to run on a
+# database created by create_all at the latest version, fresh databases are stamped without running them
+MIGRATIONS = [
+    (1, 'job execution dashboard index',
+     _create_index(JobExecution.__table__, 'ix_skx_job_execution_project_status_modified')),
+    (2, 'job execution keyset index',
+     _create_index(JobExecution.__table__, 'ix_skx_job_execution_project_modified_id')),
+    (3, 'backfill run stats rollup', _rebuild_run_stats),
+]
+
+
+def current_version(connection):
+    version = connection.execute(select(SchemaVersion.version).order_by(SchemaVersion.version.desc())).scalar()
+    return version or 0
+
+
+def migrate():
+    '''
+    create missing tables and bring an existing database up to the latest schema version
+    :return: schema version
+    '''
+    fresh = not inspect(engine).has_table('skx_project')
+    Base.metadata.create_all(engine, checkfirst=True)
+    with engine.begin() as connection:
+        if fresh:
+            version = MIGRATIONS[-1][0]
+            connection.execute(SchemaVersion.__table__.insert().values(version=version, description='initial'))
+            return version
+        version = current_version(connection)
+    for migration_version, description, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        logger.info('migrate to %s: %s' % (migration_version, description))
+        with engine.begin() as connection:
+            migration(connection)
+            connection.execute(SchemaVersion.__table__.insert().values(version=migration_version,
+                                                                       description=description))
+        version = migration_version
+    return version
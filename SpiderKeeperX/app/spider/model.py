@@ -1,24 +1,230 @@
+import base64
+import contextlib
+import contextvars
 import datetime
-from sqlalchemy import desc, select
-from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy import Column, String, INTEGER, Text, DATETIME, Integer, DateTime, text
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
+import hashlib
+import json
+import logging
+import threading
+import time
+from sqlalchemy import desc, select, insert, update, delete, and_, or_
+from sqlalchemy.orm import DeclarativeBase, relationship, foreign, joinedload, make_transient_to_detached
+from sqlalchemy import Column, String, INTEGER, Text, DATETIME, Integer, DateTime, Index, Float, func, case
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.orm import scoped_session, sessionmaker
+from starlette.concurrency import run_in_threadpool
 import sqlalchemy
 
-from SpiderKeeperX.config import SQLALCHEMY_DATABASE_URI
-
-engine = create_engine(SQLALCHEMY_DATABASE_URI)
-session = Session(engine)
+from SpiderKeeperX.app.util.cache import VersionedCache
+from SpiderKeeperX.app.util.metrics import Counter, Histogram
+from SpiderKeeperX.config import SQLALCHEMY_DATABASE_URI, SQLALCHEMY_ASYNC_DATABASE_URI, DATABASE_CONNECT_OPTIONS, \
+    SQLALCHEMY_POOL_SIZE, SQLALCHEMY_MAX_OVERFLOW, SQLALCHEMY_POOL_TIMEOUT, SQLALCHEMY_POOL_RECYCLE, \
+    SQLITE_BUSY_TIMEOUT, MODEL_CACHE_SIZE, MODEL_CACHE_TTL
+
+logger = logging.getLogger("[MODEL]")
+
+
+def _create_engine(database_uri):
+    if sqlalchemy.engine.make_url(database_uri).get_backend_name() == 'sqlite':
+        sqlite_engine = create_engine(database_uri,
+                                      connect_args=dict({'timeout': SQLITE_BUSY_TIMEOUT}, **DATABASE_CONNECT_OPTIONS))
+
+        @event.listens_for(sqlite_engine, 'connect')
+        def _set_sqlite_pragma(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.execute('PRAGMA busy_timeout=%d' % (SQLITE_BUSY_TIMEOUT * 1000))
+            cursor.close()
+        return sqlite_engine
+    return create_engine(database_uri,
+                         connect_args=DATABASE_CONNECT_OPTIONS,
+                         pool_size=SQLALCHEMY_POOL_SIZE,
+                         max_overflow=SQLALCHEMY_MAX_OVERFLOW,
+                         pool_timeout=SQLALCHEMY_POOL_TIMEOUT,
+                         pool_recycle=SQLALCHEMY_POOL_RECYCLE,
+                         pool_pre_ping=True)
+
+engine = _create_engine(SQLALCHEMY_DATABASE_URI)
+SessionLocal = sessionmaker(engine)
+
+# a web request gets a session of its own, any other thread (scheduler jobs, workers) one per thread
+_session_scope = contextvars.ContextVar('skx_session_scope', default=None)
+
+def _current_session_scope():
+    scope = _session_scope.get()
+    return scope if scope is not None else threading.get_ident()
+
+session = scoped_session(SessionLocal, scopefunc=_current_session_scope)
+
+@contextlib.contextmanager
+def session_scope():
+    '''
+    run a block with a fresh session which is closed at the end
+    '''
+    token = _session_scope.set(object())
+    try:
+        yield session()
+    finally:
+        session.remove()
+        _session_scope.reset(token)
+
+def get_session():
+    '''
+    fastapi dependency, the session of the current request
+    '''
+    return session()
+
+DB_QUERY_SECONDS = Histogram('skx_db_query_seconds', 'database statement latency')
+HTTP_REQUEST_SECONDS = Histogram('skx_http_request_seconds', 'web request latency by route', ['route', 'method'])
+HTTP_DB_QUERIES = Counter('skx_http_db_queries_total', 'database statements run by web requests', ['route'])
+HTTP_DB_SECONDS = Counter('skx_http_db_seconds_total', 'database time spent by web requests', ['route'])
+
+# [statement count, seconds] of the current web request
+_request_queries = contextvars.ContextVar('skx_request_queries', default=None)
+
+@event.listens_for(engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('skx_query_start', []).append(time.perf_counter())
+
+@event.listens_for(engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['skx_query_start'].pop()
+    DB_QUERY_SECONDS.observe(duration)
+    queries = _request_queries.get()
+    if queries is not None:
+        queries[0] += 1
+        queries[1] += duration
+
+@event.listens_for(engine, 'handle_error')
+def _handle_error(exception_context):
+    if exception_context.connection is not None and exception_context.connection.info.get('skx_query_start'):
+        exception_context.connection.info['skx_query_start'].pop()
+
+class RequestMetricsMiddleware(object):
+    '''
+    asgi middleware recording the latency and the database statements of every request by route
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        queries = [0, 0.0]
+        token = _request_queries.set(queries)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_queries.reset(token)
+            # the router leaves the matched route in the scope
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, route=route, method=scope['method'])
+            HTTP_DB_QUERIES.inc(queries[0], route=route)
+            HTTP_DB_SECONDS.inc(queries[1], route=route)
+
+class SessionScopeMiddleware(object):
+    '''
+    asgi middleware giving every request its own session, closed once the response is fully sent
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        token = _session_scope.set(object())
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await run_in_threadpool(session.remove)
+            _session_scope.reset(token)
+
+# optional async engine, serves the read only json api without holding a worker thread
+async_engine = None
+AsyncSessionLocal = None
+if SQLALCHEMY_ASYNC_DATABASE_URI:
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    async_engine = create_async_engine(SQLALCHEMY_ASYNC_DATABASE_URI)
+    AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+# sqlite stores CURRENT_TIMESTAMP as text without fraction, bind datetimes the same way
+# so comparing the column against a python datetime compares like with like
+TimestampType = DateTime().with_variant(
+    sqlite.DATETIME(storage_format='%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d'), 'sqlite')
 
 class Base(DeclarativeBase):
     __abstract__ = True
 
     id = Column(Integer, primary_key=True, autoincrement=True, nullable=False)
-    date_created = Column(DateTime, default=sqlalchemy.func.current_timestamp())
-    date_modified = Column(DateTime, default=sqlalchemy.func.current_timestamp(),
+    date_created = Column(TimestampType, default=sqlalchemy.func.current_timestamp())
+    date_modified = Column(TimestampType, default=sqlalchemy.func.current_timestamp(),
                               onupdate=sqlalchemy.func.current_timestamp())
 
+MODEL_CACHE_REQUESTS = Counter('skx_model_cache_requests_total', 'identity cache lookups', ['model', 'result'])
+
+
+class IdentityCache(VersionedCache):
+    '''
+    column snapshots of one model keyed by id, a hit is merged into the current session without a
+    query. unique columns listed in alternate_keys can be looked up too. writers invalidate the
+    ids they change
+    '''
+
+    def __init__(self, model, alternate_keys=(), max_size=MODEL_CACHE_SIZE, ttl=MODEL_CACHE_TTL):
+        super(IdentityCache, self).__init__(ttl, max_size=max_size)
+        self.model = model
+        self.alternate_keys = tuple(alternate_keys)
+        # (column, value) -> id
+        self._aliases = {}
+
+    def _stored(self, instance_id, snapshot):
+        for column in self.alternate_keys:
+            self._aliases[(column, snapshot[column])] = instance_id
+
+    def _dropped(self, instance_id, snapshot):
+        for column in self.alternate_keys:
+            self._aliases.pop((column, snapshot[column]), None)
+
+    def _lookup(self, column, value):
+        if column == 'id':
+            return self.lookup(value)
+        with self._lock:
+            instance_id = self._aliases.get((column, value))
+        snapshot = self.lookup(instance_id) if instance_id is not None else None
+        return snapshot if snapshot is not None and snapshot[column] == value else None
+
+    def get(self, column, value, loader):
+        '''
+        :param column: 'id' or one of alternate_keys
+        :param value:
+        :param loader: runs the query on a miss, returns the instance or None
+        :return: instance attached to the current session, the one it already holds if any
+        '''
+        snapshot = self._lookup(column, value)
+        if snapshot is not None:
+            MODEL_CACHE_REQUESTS.inc(model=self.model.__name__, result='hit')
+            # an instance the session already holds may carry unflushed changes, never overwrite it
+            instance = session.identity_map.get(
+                sqlalchemy.inspect(self.model).identity_key_from_primary_key([snapshot['id']]))
+            if instance is not None:
+                return instance
+            instance = self.model(**snapshot)
+            make_transient_to_detached(instance)
+            return session.merge(instance, load=False)
+        MODEL_CACHE_REQUESTS.inc(model=self.model.__name__, result='miss')
+        version = self.version()
+        instance = loader()
+        if instance is not None:
+            self.store(instance.id, dict((attr.key, getattr(instance, attr.key))
+                                         for attr in sqlalchemy.inspect(self.model).column_attrs), version)
+        return instance
+
+
 class Project(Base):
     __tablename__ = 'skx_project'
 
@@ -27,14 +233,25 @@ class Project(Base):
     @classmethod
     def load_project(cls, project_list):
         for project in project_list:
-            existed_project = session.execute(select(cls).filter_by(project_name=project.project_name)).scalar_one()
+            existed_project = cls.find_project_by_name(project.project_name)
             if not existed_project:
                 session.add(project)
                 session.commit()
 
     @classmethod
     def find_project_by_id(cls, project_id):
-        return session.execute(select(Project).where(Project.id==project_id)).scalar_one()
+        project_id = _cache_id(project_id)
+        return project_cache.get('id', project_id, lambda: session.execute(
+            select(Project).where(Project.id==project_id)).scalar_one())
+
+    @classmethod
+    def find_project_by_name(cls, project_name):
+        return project_cache.get('project_name', project_name, lambda: session.execute(
+            select(Project).filter_by(project_name=project_name)).scalars().first())
+
+    @classmethod
+    def invalidate(cls, project_id=None, **payload):
+        project_cache.invalidate(_cache_id(project_id) if project_id is not None else None)
 
     def to_dict(self):
         return {
@@ -48,23 +265,34 @@ class SpiderInstance(Base):
     spider_name = Column(String(100))
     project_id = Column(INTEGER, nullable=False, index=True)
 
+    # project_id -> fingerprint of the spider names last synced
+    _spider_list_fingerprints = {}
+
     @classmethod
     def update_spider_instances(cls, project_id, spider_instance_list):
-        for spider_instance in spider_instance_list:
-            existed_spider_instance = session.execute(select(cls).filter_by(project_id=project_id,
-                                                          spider_name=spider_instance.spider_name)).scalar_one()
-            if not existed_spider_instance:
-                session.add(spider_instance)
-                session.commit()
-
-        for spider in session.execute(select(cls).filter_by(project_id=project_id)).scalars():
-            existed_spider = any(
-                spider.spider_name == s.spider_name
-                for s in spider_instance_list
-            )
-            if not existed_spider:
-                session.delete(spider)
-                session.commit()
+        '''
+        diff the remote spider list against the stored one and apply it in one transaction,
+        unchanged lists are skipped without touching the db
+        :param project_id:
+        :param spider_instance_list:
+        :return: True if spiders of the project changed
+        '''
+        spider_names = set(spider_instance.spider_name for spider_instance in spider_instance_list)
+        fingerprint = hashlib.sha1('\n'.join(sorted(spider_names)).encode('utf8')).hexdigest()
+        if cls._spider_list_fingerprints.get(project_id) == fingerprint:
+            return False
+        existed_spider_names = set(session.execute(select(cls.spider_name).filter_by(project_id=project_id)).scalars())
+        added_spider_names = spider_names - existed_spider_names
+        removed_spider_names = existed_spider_names - spider_names
+        if added_spider_names:
+            session.execute(insert(cls), [dict(project_id=project_id, spider_name=spider_name)
+                                          for spider_name in added_spider_names])
+        if removed_spider_names:
+            session.execute(delete(cls).where(cls.project_id == project_id,
+                                              cls.spider_name.in_(removed_spider_names)))
+        session.commit()
+        cls._spider_list_fingerprints[project_id] = fingerprint
+        return bool(added_spider_names or removed_spider_names)
 
     @classmethod
     def list_spider_by_project_id(cls, project_id):
@@ -77,29 +305,19 @@ class SpiderInstance(Base):
 
     @classmethod
     def list_spiders(cls, project_id):
-        sql_last_runtime = text('''
-            select * from (select a.spider_name,b.date_created from skx_job_instance as a
-                left join skx_job_execution as b
-                on a.id = b.job_instance_id
-                order by b.date_created desc) as c
-                group by c.spider_name
-            ''')
-        sql_avg_runtime = text('''
-            select a.spider_name,avg(end_time-start_time) from skx_job_instance as a
-                left join skx_job_execution as b
-                on a.id = b.job_instance_id
-                where b.end_time is not null
-                group by a.spider_name
-            ''')
-        last_runtime_list = dict(
-            (spider_name, last_run_time) for spider_name, last_run_time in session.execute(sql_last_runtime))
-        avg_runtime_list = dict(
-            (spider_name, avg_run_time) for spider_name, avg_run_time in session.execute(sql_avg_runtime))
+        last_runtime_list = {}
+        avg_runtime_list = {}
+        for spider_name, last_run_time, runtime_sum, success_count in session.execute(
+                select(JobRunStats.spider_name, func.max(JobRunStats.last_run_time), func.sum(JobRunStats.runtime_sum),
+                       func.sum(JobRunStats.success_count)).filter(JobRunStats.project_id == project_id).group_by(
+                    JobRunStats.spider_name)):
+            last_runtime_list[spider_name] = last_run_time
+            avg_runtime_list[spider_name] = runtime_sum / success_count if success_count else None
         res = []
         for spider in session.execute(select(cls).filter_by(project_id=project_id)).scalars():
             last_runtime = last_runtime_list.get(spider.spider_name)
             res.append(dict(spider.to_dict(),
-                            **{'spider_last_runtime': last_runtime if last_runtime else '-',
+                            **{'spider_last_runtime': last_runtime.strftime('%Y-%m-%d %H:%M:%S') if last_runtime else '-',
                                'spider_avg_runtime': avg_runtime_list.get(spider.spider_name)
                                }))
         return res
@@ -155,13 +373,46 @@ class JobInstance(Base):
 
     @classmethod
     def find_job_instance_by_id(cls, job_instance_id):
-        return session.execute(select(cls).filter_by(id=job_instance_id)).scalar_one()
+        job_instance_id = _cache_id(job_instance_id)
+        return job_instance_cache.get('id', job_instance_id, lambda: session.execute(
+            select(cls).filter_by(id=job_instance_id)).scalar_one())
+
+    @classmethod
+    def invalidate(cls, job_instance_id=None, **payload):
+        job_instance_cache.invalidate(_cache_id(job_instance_id) if job_instance_id is not None else None)
+
+    @classmethod
+    def periodic_version(cls):
+        '''
+        :return: (count, max id, max date_modified) of periodic job instances, changes whenever one
+        is added, edited, switched or removed
+        '''
+        return tuple(session.execute(select(func.count(cls.id), func.max(cls.id), func.max(cls.date_modified)).filter(
+            cls.run_type == JobRunType.PERIODIC)).one())
+
+def _cache_id(instance_id):
+    # ids from url paths arrive as strings
+    try:
+        return int(instance_id)
+    except (TypeError, ValueError):
+        return instance_id
+
+
+project_cache = IdentityCache(Project, alternate_keys=('project_name',))
+job_instance_cache = IdentityCache(JobInstance)
+
 
 class SpiderStatus():
     PENDING, RUNNING, FINISHED, CANCELED = range(4)
 
 class JobExecution(Base):
     __tablename__ = 'skx_job_execution'
+    __table_args__ = (
+        # each dashboard status bucket is a range scan of this index
+        Index('ix_skx_job_execution_project_status_modified', 'project_id', 'running_status', 'date_modified'),
+        # keyset pagination order of the job execution api
+        Index('ix_skx_job_execution_project_modified_id', 'project_id', 'date_modified', 'id'),
+    )
 
     project_id = Column(INTEGER, nullable=False, index=True)
     service_job_execution_id = Column(String(50), nullable=False, index=True)
@@ -172,8 +423,11 @@ class JobExecution(Base):
     running_status = Column(INTEGER, default=SpiderStatus.PENDING)
     running_on = Column(Text)
 
+    job_instance = relationship(JobInstance, viewonly=True,
+                                primaryjoin=lambda: foreign(JobExecution.job_instance_id) == JobInstance.id)
+
     def to_dict(self):
-        job_instance = session.execute(select(JobInstance).filter_by(id=self.job_instance_id)).scalar_one()
+        job_instance = self.job_instance
         return {
             'project_id': self.project_id,
             'job_execution_id': self.id,
@@ -187,6 +441,10 @@ class JobExecution(Base):
             'job_instance': job_instance.to_dict() if job_instance else {}
         }
 
+    @classmethod
+    def find_job_execution(cls, project_id, job_execution_id):
+        return session.execute(select(cls).filter_by(project_id=project_id, id=job_execution_id)).scalar_one_or_none()
+
     @classmethod
     def find_job_by_service_id(cls, service_job_execution_id):
         return session.execute(select(cls).filter_by(service_job_execution_id=service_job_execution_id)).scalar_one()
@@ -197,25 +455,84 @@ class JobExecution(Base):
 
     @classmethod
     def list_uncomplete_job(cls):
-        return session.execute(select(cls).filter(cls.running_status != SpiderStatus.FINISHED,
+        return session.execute(select(cls).options(joinedload(cls.job_instance)).filter(
+                                cls.running_status != SpiderStatus.FINISHED,
                                 cls.running_status != SpiderStatus.CANCELED)).scalars()
 
+    @classmethod
+    def _list_jobs_by_status(cls, project_id, running_status_list, limit):
+        return session.execute(select(cls).options(joinedload(cls.job_instance)).filter(
+            cls.project_id == project_id, cls.running_status.in_(running_status_list)).order_by(
+            desc(cls.date_modified)).limit(limit)).scalars()
+
     @classmethod
     def list_jobs(cls, project_id, each_status_limit=100):
         result = {}
         result['PENDING'] = [job_execution.to_dict() for job_execution in
-                            session.execute(select(JobExecution).filter_by( project_id=project_id, running_status=SpiderStatus.PENDING
-                            ).order_by(desc(JobExecution.date_modified)).limit(each_status_limit))]
+                             cls._list_jobs_by_status(project_id, [SpiderStatus.PENDING], each_status_limit)]
         result['RUNNING'] = [job_execution.to_dict() for job_execution in
-                            session.execute(select(JobExecution).filter_by(project_id=project_id, running_status=SpiderStatus.RUNNING).order_by(
-                                 desc(JobExecution.date_modified)).limit(each_status_limit))]
+                             cls._list_jobs_by_status(project_id, [SpiderStatus.RUNNING], each_status_limit)]
         result['COMPLETED'] = [job_execution.to_dict() for job_execution in
-        session.execute(select(JobExecution).filter(JobExecution.project_id == project_id).filter(
-                                   (JobExecution.running_status == SpiderStatus.FINISHED) | (
-                                       JobExecution.running_status == SpiderStatus.CANCELED)).order_by(
-                                   desc(JobExecution.date_modified)).limit(each_status_limit))]
+                               cls._list_jobs_by_status(project_id, [SpiderStatus.FINISHED, SpiderStatus.CANCELED],
+                                                        each_status_limit)]
         return result
 
+    @staticmethod
+    def encode_cursor(job_execution):
+        '''
+        :param job_execution: last job execution of a page
+        :return: opaque cursor pointing after it
+        '''
+        raw = '%s|%s' % (job_execution.date_modified.isoformat(), job_execution.id)
+        return base64.urlsafe_b64encode(raw.encode('utf8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        '''
+        :param cursor:
+        :return: (date_modified, id), raise ValueError on malformed cursor
+        '''
+        try:
+            date_modified, job_execution_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8').split('|')
+            return datetime.datetime.fromisoformat(date_modified), int(job_execution_id)
+        except Exception:
+            raise ValueError('invalid cursor %s' % cursor)
+
+    @classmethod
+    def jobs_page_query(cls, project_id, cursor=None, limit=100, running_status=None, spider_name=None,
+                        running_on=None, since=None, until=None):
+        '''
+        one page of job executions newest first, paged by (date_modified, id) keyset
+        so deep pages cost the same as the first one
+        :param project_id:
+        :param cursor: cursor returned with the previous page
+        :param limit:
+        :param running_status:
+        :param spider_name:
+        :param running_on: daemon
+        :param since: date_modified lower bound, inclusive
+        :param until: date_modified upper bound, exclusive
+        :return: select statement, raise ValueError on malformed cursor
+        '''
+        query = select(cls).options(joinedload(cls.job_instance)).filter(cls.project_id == project_id)
+        if cursor:
+            date_modified, job_execution_id = cls.decode_cursor(cursor)
+            query = query.filter(or_(cls.date_modified < date_modified,
+                                     and_(cls.date_modified == date_modified, cls.id < job_execution_id)))
+        if running_status is not None:
+            query = query.filter(cls.running_status == running_status)
+        if spider_name:
+            query = query.filter(cls.job_instance_id.in_(
+                select(JobInstance.id).filter_by(project_id=project_id, spider_name=spider_name)))
+        if running_on:
+            query = query.filter(cls.running_on == running_on)
+        if since:
+            query = query.filter(cls.date_modified >= since)
+        if until:
+            query = query.filter(cls.date_modified < until)
+        query = query.order_by(desc(cls.date_modified), desc(cls.id)).limit(limit)
+        return query.execution_options(yield_per=200)
+
     @classmethod
     def list_run_stats_by_hours(cls, project_id):
         result = {}
@@ -227,7 +544,312 @@ class JobExecution(Base):
             hour_key = time_tmp.strftime('%Y-%m-%d %H:00:00')
             hour_keys.append(hour_key)
             result[hour_key] = 0  # init
-        for job_execution in session.execute(select(JobExecution).filter(JobExecution.project_id == project_id, JobExecution.date_created >= last_time)).scalars():
-            hour_key = job_execution.create_time.strftime('%Y-%m-%d %H:00:00')
-            result[hour_key] += 1
+        for hour, run_count in session.execute(
+                select(JobRunStats.hour, func.sum(JobRunStats.run_count)).filter(
+                    JobRunStats.project_id == project_id, JobRunStats.hour >= last_time).group_by(JobRunStats.hour)):
+            hour_key = hour.strftime('%Y-%m-%d %H:00:00')
+            if hour_key in result:
+                result[hour_key] += run_count
         return [dict(key=hour_key, value=result[hour_key]) for hour_key in hour_keys]
+
+
+class JobRunStats(Base):
+    '''
+    hourly rollup of job executions per project/spider/daemon, bucketed by create time.
+    maintained as executions are launched and change status so stats never scan executions
+    '''
+    __tablename__ = 'skx_job_run_stats'
+    __table_args__ = (
+        Index('ix_skx_job_run_stats_bucket', 'project_id', 'hour', 'spider_name', 'running_on', unique=True),
+    )
+
+    project_id = Column(INTEGER, nullable=False)
+    spider_name = Column(String(100), nullable=False)
+    running_on = Column(String(255), nullable=False, default='')
+    hour = Column(DATETIME, nullable=False)
+    run_count = Column(INTEGER, nullable=False, default=0)
+    success_count = Column(INTEGER, nullable=False, default=0)
+    cancel_count = Column(INTEGER, nullable=False, default=0)
+    runtime_sum = Column(Float, nullable=False, default=0)  # seconds of finished executions
+    runtime_min = Column(Float)
+    runtime_max = Column(Float)
+    last_run_time = Column(DATETIME)
+
+    @classmethod
+    def record(cls, job_execution, spider_name, run_count=0, success_count=0, cancel_count=0):
+        '''
+        fold one execution event into its bucket, the caller commits. the bucket is bumped by a single
+        update in a savepoint, so concurrent recorders never lose counts and a failing rollup never
+        rolls back the execution it is recorded with
+        :param job_execution:
+        :param spider_name:
+        :param run_count: 1 when launched
+        :param success_count: 1 when finished, the runtime is folded in too
+        :param cancel_count: 1 when canceled
+        :return:
+        '''
+        if not job_execution.create_time:
+            return
+        bucket = dict(project_id=job_execution.project_id, spider_name=spider_name,
+                      running_on=job_execution.running_on or '',
+                      hour=job_execution.create_time.replace(minute=0, second=0, microsecond=0))
+        values = dict(run_count=cls.run_count + run_count, success_count=cls.success_count + success_count,
+                      cancel_count=cls.cancel_count + cancel_count)
+        if run_count:
+            create_time = job_execution.create_time
+            values['last_run_time'] = case((or_(cls.last_run_time == None, cls.last_run_time < create_time),
+                                            create_time), else_=cls.last_run_time)
+        runtime = None
+        if success_count and job_execution.start_time and job_execution.end_time:
+            runtime = (job_execution.end_time - job_execution.start_time).total_seconds()
+            values['runtime_sum'] = cls.runtime_sum + runtime
+            values['runtime_min'] = case((or_(cls.runtime_min == None, cls.runtime_min > runtime), runtime),
+                                         else_=cls.runtime_min)
+            values['runtime_max'] = case((or_(cls.runtime_max == None, cls.runtime_max < runtime), runtime),
+                                         else_=cls.runtime_max)
+        bump = update(cls).filter_by(**bucket).values(**values).execution_options(synchronize_session=False)
+        try:
+            with session.begin_nested():
+                if session.execute(bump).rowcount:
+                    return
+                try:
+                    # first event of the bucket, a concurrent recorder may insert it first
+                    with session.begin_nested():
+                        session.execute(insert(cls).values(
+                            run_count=run_count, success_count=success_count, cancel_count=cancel_count,
+                            runtime_sum=runtime or 0, runtime_min=runtime, runtime_max=runtime,
+                            last_run_time=job_execution.create_time if run_count else None, **bucket))
+                except sqlalchemy.exc.IntegrityError:
+                    session.execute(bump)
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logger.error('run stats of job execution %s not recorded: %s' % (job_execution.id, e))
+
+    @classmethod
+    def rebuild(cls, connection):
+        '''
+        rebuild the rollup from all executions in one insert from select, for databases created
+        before the rollup existed. executions removed by the retention purge are lost from a rebuilt rollup
+        :param connection: connection of the running migration, the caller commits
+        :return:
+        '''
+        dialect = connection.dialect.name
+        finished = JobExecution.running_status == SpiderStatus.FINISHED
+        timed = and_(finished, JobExecution.start_time != None, JobExecution.end_time != None)
+        runtime = case((timed, _seconds_between(JobExecution.start_time, JobExecution.end_time, dialect)))
+        hour = _hour_bucket(JobExecution.create_time, dialect)
+        running_on = func.coalesce(JobExecution.running_on, '')
+        rollup = select(
+            JobExecution.project_id, JobInstance.spider_name, running_on, hour, func.count(JobExecution.id),
+            func.sum(case((finished, 1), else_=0)),
+            func.sum(case((JobExecution.running_status == SpiderStatus.CANCELED, 1), else_=0)),
+            func.coalesce(func.sum(runtime), 0), func.min(runtime), func.max(runtime),
+            func.max(JobExecution.create_time)).join(
+            JobInstance, JobInstance.id == JobExecution.job_instance_id).filter(
+            JobExecution.create_time != None).group_by(JobExecution.project_id, JobInstance.spider_name, running_on, hour)
+        connection.execute(delete(cls))
+        connection.execute(insert(cls).from_select(
+            ['project_id', 'spider_name', 'running_on', 'hour', 'run_count', 'success_count', 'cancel_count',
+             'runtime_sum', 'runtime_min', 'runtime_max', 'last_run_time'], rollup))
+
+
+def _hour_bucket(column, dialect):
+    '''
+    the datetime column truncated to the hour, stored the way record() binds the bucket
+    '''
+    if dialect == 'sqlite':
+        return func.strftime('%Y-%m-%d %H:00:00.000000', column)
+    if dialect == 'mysql':
+        return func.date_format(column, '%Y-%m-%d %H:00:00')
+    return func.date_trunc('hour', column)
+
+
+def _seconds_between(start, end, dialect):
+    if dialect == 'sqlite':
+        return (func.julianday(end) - func.julianday(start)) * 86400.0
+    if dialect == 'mysql':
+        return func.timestampdiff(sqlalchemy.literal_column('MICROSECOND'), start, end) / 1000000.0
+    return sqlalchemy.extract('epoch', end - start)
+
+
+class DeployStatus():
+    OK = 'ok'
+    FAILED = 'failed'
+    UNCHANGED = 'unchanged'
+
+
+class SpiderDeploy(Base):
+    '''
+    an egg upload to one daemon, the sha256 of the egg lets an identical redeploy be skipped
+    '''
+    __tablename__ = 'skx_spider_deploy'
+    __table_args__ = (
+        Index('ix_skx_spider_deploy_project_server', 'project_id', 'server', 'id'),
+    )
+
+    project_id = Column(INTEGER, nullable=False)
+    server = Column(String(255), nullable=False)
+    version = Column(String(50))
+    egg_sha256 = Column(String(64), nullable=False)
+    status = Column(String(20), nullable=False)
+    message = Column(Text)
+
+    @classmethod
+    def last_deploy(cls, project_id, server, status=None):
+        query = select(cls).filter_by(project_id=project_id, server=server)
+        if status:
+            query = query.filter_by(status=status)
+        return session.execute(query.order_by(desc(cls.id)).limit(1)).scalar_one_or_none()
+
+    @classmethod
+    def list_latest(cls, project_id):
+        '''
+        :return: latest deploy of the project on every daemon
+        '''
+        latest_ids = select(func.max(cls.id)).filter_by(project_id=project_id).group_by(cls.server)
+        return session.execute(select(cls).filter(cls.id.in_(latest_ids)).order_by(cls.server)).scalars()
+
+    def to_dict(self):
+        return dict(project_id=self.project_id, server=self.server, version=self.version,
+                    egg_sha256=self.egg_sha256, status=self.status, message=self.message,
+                    date_created=self.date_created.strftime('%Y-%m-%d %H:%M:%S') if self.date_created else None)
+
+
+class TaskStatus():
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCESS = 'success'
+    FAILED = 'failed'
+
+
+class BackgroundTask(Base):
+    '''
+    a deploy or git sync run by the task runner, progress is a percentage
+    '''
+    __tablename__ = 'skx_task'
+    __table_args__ = (
+        Index('ix_skx_task_project_id', 'project_id', 'id'),
+        Index('ix_skx_task_status', 'status'),
+    )
+
+    project_id = Column(INTEGER, nullable=False)
+    kind = Column(String(50), nullable=False)
+    params = Column(Text)
+    status = Column(String(20), nullable=False, default=TaskStatus.PENDING)
+    progress = Column(INTEGER, nullable=False, default=0)
+    message = Column(Text)
+    result = Column(Text)
+    worker = Column(String(100))
+    started_at = Column(DATETIME)
+    heartbeat_at = Column(DATETIME)
+    finished_at = Column(DATETIME)
+
+    @classmethod
+    def create(cls, project_id, kind, params, worker):
+        '''
+        :param worker: the only worker allowed to claim the task, it holds the files the task needs
+        '''
+        task = cls(project_id=project_id, kind=kind, params=json.dumps(params), status=TaskStatus.PENDING,
+                   progress=0, worker=worker)
+        session.add(task)
+        session.commit()
+        return task
+
+    @classmethod
+    def claim(cls, task_id, worker):
+        '''
+        move a pending task of worker to running, a single conditional update so a task runs once
+        :return: True if worker got the task
+        '''
+        now = datetime.datetime.now()
+        result = session.execute(update(cls).where(
+            cls.id == task_id, cls.worker == worker, cls.status == TaskStatus.PENDING).values(
+            status=TaskStatus.RUNNING, started_at=now, heartbeat_at=now))
+        session.commit()
+        return result.rowcount == 1
+
+    @classmethod
+    def report(cls, task_id, progress, message=None):
+        session.execute(update(cls).where(cls.id == task_id).values(
+            progress=progress, message=message, heartbeat_at=datetime.datetime.now()))
+        session.commit()
+
+    @classmethod
+    def finish(cls, task_id, status, message=None, result=None):
+        values = dict(status=status, message=message, result=json.dumps(result) if result is not None else None,
+                      finished_at=datetime.datetime.now())
+        if status == TaskStatus.SUCCESS:
+            values['progress'] = 100
+        session.execute(update(cls).where(cls.id == task_id).values(**values))
+        session.commit()
+
+    @classmethod
+    def list_pending_ids(cls, worker):
+        return session.execute(select(cls.id).filter_by(status=TaskStatus.PENDING, worker=worker).order_by(
+            cls.id)).scalars().all()
+
+    @classmethod
+    def fail_stale(cls, seconds, worker):
+        '''
+        fail running tasks of worker without progress for seconds, the process running them went away
+        :return: number of tasks failed
+        '''
+        result = session.execute(update(cls).where(
+            cls.status == TaskStatus.RUNNING, cls.worker == worker,
+            cls.heartbeat_at < datetime.datetime.now() - datetime.timedelta(seconds=seconds)).values(
+            status=TaskStatus.FAILED, message='interrupted', finished_at=datetime.datetime.now()))
+        session.commit()
+        return result.rowcount
+
+    @classmethod
+    def list_by_project(cls, project_id, limit=20):
+        return session.execute(select(cls).filter_by(project_id=project_id).order_by(desc(cls.id)).limit(
+            limit)).scalars().all()
+
+    def to_dict(self):
+        return dict(task_id=self.id, project_id=self.project_id, kind=self.kind, status=self.status,
+                    progress=self.progress, message=self.message,
+                    result=json.loads(self.result) if self.result else None,
+                    date_created=self.date_created.strftime('%Y-%m-%d %H:%M:%S') if self.date_created else None,
+                    started_at=self.started_at.strftime('%Y-%m-%d %H:%M:%S') if self.started_at else None,
+                    finished_at=self.finished_at.strftime('%Y-%m-%d %H:%M:%S') if self.finished_at else None)
+
+
+class SchedulerLease(Base):
+    '''
+    a named lease row, the instance holding an unexpired lease is the leader
+    '''
+    __tablename__ = 'skx_scheduler_lease'
+
+    name = Column(String(50), nullable=False, unique=True)
+    holder = Column(String(100))
+    expires_at = Column(DATETIME)
+
+    @classmethod
+    def acquire(cls, name, holder, ttl):
+        '''
+        take or renew the lease, a single conditional update so two instances can never both win
+        :param name:
+        :param holder: id of the calling instance
+        :param ttl: seconds the lease is valid
+        :return: True if holder owns the lease
+        '''
+        now = datetime.datetime.now()
+        result = session.execute(update(cls).where(cls.name == name, or_(
+            cls.holder == holder, cls.expires_at == None, cls.expires_at < now)).values(
+            holder=holder, expires_at=now + datetime.timedelta(seconds=ttl)))
+        session.commit()
+        if result.rowcount == 1:
+            return True
+        if session.execute(select(cls.id).filter_by(name=name)).first() is None:
+            try:
+                session.add(cls(name=name, holder=holder, expires_at=now + datetime.timedelta(seconds=ttl)))
+                session.commit()
+                return True
+            except sqlalchemy.exc.IntegrityError:
+                session.rollback()
+        return False
+
+    @classmethod
+    def release(cls, name, holder):
+        session.execute(update(cls).where(cls.name == name, cls.holder == holder).values(expires_at=None))
+        session.commit()
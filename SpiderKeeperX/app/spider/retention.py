@@ -0,0 +1,110 @@
+import datetime
+import gzip
+import json
+import logging
+import os
+import time
+
+from sqlalchemy import select, delete, desc, and_, or_
+from sqlalchemy.orm import joinedload
+
+from SpiderKeeperX.app.spider.model import JobExecution, SpiderStatus, session_scope
+from SpiderKeeperX.app.util.logarchive import log_archiver, log_ref
+from SpiderKeeperX.config import JOB_EXECUTION_RETENTION_DAYS, JOB_EXECUTION_RETENTION_COUNT, \
+    JOB_EXECUTION_RETENTION_POLICIES, JOB_EXECUTION_ARCHIVE_DIR, RETENTION_BATCH_SIZE, RETENTION_BATCH_PAUSE, \
+    RETENTION_DELETE_LOGS
+
+logger = logging.getLogger("[RETENTION]")
+
+COMPLETED_STATUS = [SpiderStatus.FINISHED, SpiderStatus.CANCELED]
+
+
+def retention_policy(project):
+    '''
+    :param project:
+    :return: (days, count) kept for the project, None is no limit
+    '''
+    policy = JOB_EXECUTION_RETENTION_POLICIES.get(project.project_name, {})
+    return policy.get('days', JOB_EXECUTION_RETENTION_DAYS), policy.get('count', JOB_EXECUTION_RETENTION_COUNT)
+
+
+def expired_filter(db, project_id, days, count):
+    '''
+    completed executions older than days or past the newest count ones
+    :return: filter clause, None if nothing can expire
+    '''
+    clauses = []
+    if days is not None:
+        clauses.append(JobExecution.date_modified < datetime.datetime.now() - datetime.timedelta(days=days))
+    if count is not None:
+        boundary = db.execute(select(JobExecution.date_modified, JobExecution.id).filter(
+            JobExecution.project_id == project_id, JobExecution.running_status.in_(COMPLETED_STATUS)).order_by(
+            desc(JobExecution.date_modified), desc(JobExecution.id)).offset(count).limit(1)).first()
+        if boundary:
+            clauses.append(or_(JobExecution.date_modified < boundary.date_modified,
+                               and_(JobExecution.date_modified == boundary.date_modified,
+                                    JobExecution.id <= boundary.id)))
+    if not clauses:
+        return None
+    return and_(JobExecution.project_id == project_id, JobExecution.running_status.in_(COMPLETED_STATUS),
+                or_(*clauses))
+
+
+def archive_path(project_id, day=None):
+    day = day or datetime.date.today()
+    return os.path.join(JOB_EXECUTION_ARCHIVE_DIR, str(project_id), 'job_execution-%s.jsonl.gz' % day.strftime('%Y%m%d'))
+
+
+def archive_job_executions(project_id, job_executions):
+    '''
+    append executions as json lines to the gzip archive of the day, every batch is a gzip member of its own
+    '''
+    path = archive_path(project_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, 'at', encoding='utf8') as f:
+        for job_execution in job_executions:
+            row = job_execution.to_dict()
+            row['date_created'] = job_execution.date_created.isoformat() if job_execution.date_created else None
+            row['date_modified'] = job_execution.date_modified.isoformat() if job_execution.date_modified else None
+            f.write(json.dumps(row) + '\n')
+
+
+def purge_job_executions(project, batch_size=RETENTION_BATCH_SIZE, pause=RETENTION_BATCH_PAUSE):
+    '''
+    archive and delete the expired executions of a project in small batches, each batch is a short
+    transaction of its own so the status sync and the web tier are never locked out for long.
+    run stats of the executions stay in the hourly rollup
+    :param project:
+    :param batch_size:
+    :param pause: seconds slept between two batches
+    :return: number of deleted executions
+    '''
+    days, count = retention_policy(project)
+    purged = 0
+    with session_scope() as db:
+        expired = expired_filter(db, project.id, days, count)
+        if expired is None:
+            return 0
+        # the count boundary is fixed before deleting, so a run stops at what was expired when it started
+        query = select(JobExecution).options(joinedload(JobExecution.job_instance)).filter(expired).order_by(
+            JobExecution.date_modified, JobExecution.id).limit(batch_size)
+        while True:
+            job_executions = list(db.execute(query).scalars())
+            if not job_executions:
+                break
+            if JOB_EXECUTION_ARCHIVE_DIR:
+                archive_job_executions(project.id, job_executions)
+            job_execution_ids = [job_execution.id for job_execution in job_executions]
+            log_refs = [log_ref(job_execution) for job_execution in job_executions]
+            db.execute(delete(JobExecution).where(JobExecution.id.in_(job_execution_ids)))
+            db.commit()
+            db.expunge_all()
+            if RETENTION_DELETE_LOGS:
+                log_archiver.delete_many(log_refs)
+            purged += len(job_execution_ids)
+            if len(job_executions) < batch_size:
+                break
+            time.sleep(pause)
+    if purged:
+        logger.info('purged %s job executions of project %s' % (purged, project.project_name))
+    return purged
@@ -0,0 +1,95 @@
+import collections
+import threading
+import time
+
+
+class VersionedCache(object):
+    '''
+    in process cache of loaded values, entries expire after ttl seconds and the least recently
+    used go first past max_size. every invalidation bumps the version, a load that started before
+    it is never stored, so a reader never brings back a value its writer just dropped
+    '''
+
+    def __init__(self, ttl, max_size=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._version = 0
+        # key -> (loaded_at, value)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def version(self):
+        with self._lock:
+            return self._version
+
+    def lookup(self, key):
+        '''
+        :return: the cached value, None on a miss or once expired
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] >= self.ttl:
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def store(self, key, value, version):
+        '''
+        :param version: version() taken before the load of value
+        :return: True if stored, False if an invalidation raced with the load
+        '''
+        with self._lock:
+            if version != self._version:
+                return False
+            self._drop(key)
+            self._entries[key] = (time.monotonic(), value)
+            self._stored(key, value)
+            while self.max_size is not None and len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+            return True
+
+    def load(self, key, loader):
+        '''
+        :param loader: runs on a miss, a None result is not cached
+        '''
+        value = self.lookup(key)
+        if value is not None:
+            return value
+        version = self.version()
+        value = loader()
+        if value is not None:
+            self.store(key, value, version)
+        return value
+
+    def invalidate(self, key=None):
+        '''
+        :param key: key written, None clears everything
+        '''
+        with self._lock:
+            self._version += 1
+            if key is None:
+                for key in list(self._entries):
+                    self._drop(key)
+            else:
+                self._drop(key)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._dropped(key, entry[1])
+
+    def _stored(self, key, value):
+        '''
+        called with the lock held once value is cached
+        '''
+
+    def _dropped(self, key, value):
+        '''
+        called with the lock held once value left the cache
+        '''
@@ -0,0 +1,42 @@
+import collections
+import logging
+import threading
+
+logger = logging.getLogger("[EVENTS]")
+
+# job_instance_id, a job instance was added, edited, switched or removed
+JOB_INSTANCE_CHANGED = 'job_instance_changed'
+# project_id, a project was created or deleted
+PROJECT_CHANGED = 'project_changed'
+# project_id, the spider sync added or removed spiders of the project
+SPIDERS_CHANGED = 'spiders_changed'
+
+_handlers = collections.defaultdict(list)
+_handlers_lock = threading.Lock()
+
+
+def subscribe(event, handler):
+    '''
+    call handler(**payload) on every publish of event
+    '''
+    with _handlers_lock:
+        _handlers[event].append(handler)
+
+
+def unsubscribe(event, handler):
+    with _handlers_lock:
+        if handler in _handlers[event]:
+            _handlers[event].remove(handler)
+
+
+def publish(event, **payload):
+    '''
+    run the handlers of event in the calling thread, a failing handler does not stop the others
+    '''
+    with _handlers_lock:
+        handlers = list(_handlers[event])
+    for handler in handlers:
+        try:
+            handler(**payload)
+        except Exception as e:
+            logger.error('handler %s of %s failed: %s' % (handler.__name__, event, e))
@@ -1,39 +1,182 @@
 import logging
+import os
+import random
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 
+from SpiderKeeperX.config import HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_RETRY_TIMES, \
+    HTTP_RETRY_BACKOFF, HTTP_RETRY_BACKOFF_MAX
 
-def request_get(url, retry_times=5):
+# status codes worth another attempt, anything else is returned to the caller
+RETRY_STATUS_CODES = (502, 503, 504)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url):
     '''
+    shared keep-alive session of the daemon serving url, one connection pool per daemon
     :param url:
-    :param retry_times:
-    :return: response obj
+    :return: requests.Session
     '''
-    for i in range(retry_times):
+    netloc = urlsplit(url).netloc
+    http_session = _sessions.get(netloc)
+    if http_session is None:
+        with _sessions_lock:
+            http_session = _sessions.get(netloc)
+            if http_session is None:
+                http_session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+                http_session.mount('http://', adapter)
+                http_session.mount('https://', adapter)
+                _sessions[netloc] = http_session
+    return http_session
+
+
+def backoff_delay(attempt):
+    '''
+    exponential backoff with full jitter
+    :param attempt: 0 based attempt number
+    :return: seconds to sleep
+    '''
+    return random.uniform(0, min(HTTP_RETRY_BACKOFF_MAX, HTTP_RETRY_BACKOFF * (2 ** attempt)))
+
+
+def _send(method, url, retry_times, timeout, **kwargs):
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    http_session = get_session(url)
+    res = None
+    for i in range(max(retry_times, 1)):
+        if i:
+            time.sleep(backoff_delay(i - 1))
+            # a streamed body was consumed by the failed attempt
+            if hasattr(kwargs.get('data'), 'seek'):
+                kwargs['data'].seek(0)
         try:
-            res = requests.get(url)
-        except Exception as e:
-            logging.warning('request error retry %s' % url)
+            res = http_session.request(method, url, timeout=timeout, **kwargs)
+        except requests.RequestException as e:
+            logging.warning('request error retry %s: %s' % (url, e))
+            res = None
             continue
-        return res
+        if res.status_code not in RETRY_STATUS_CODES:
+            break
+        logging.warning('request status %s retry %s' % (res.status_code, url))
+    return res
 
 
-def request_post(url, data, retry_times=5):
+def request_get(url, retry_times=HTTP_RETRY_TIMES, timeout=None):
     '''
     :param url:
     :param retry_times:
+    :param timeout: seconds or (connect, read) tuple, None means the configured defaults
     :return: response obj
     '''
-    for i in range(retry_times):
-        try:
-            res = requests.post(url, data)
-        except Exception as e:
-            logging.warning('request error retry %s' % url)
-            continue
-        return res
+    return _send('GET', url, retry_times, timeout)
+
+
+def request_post(url, data, retry_times=HTTP_RETRY_TIMES, timeout=None, idempotent=False, files=None, headers=None):
+    '''
+    :param url:
+    :param data: form dict, or a seekable file like body which is streamed
+    :param retry_times: only used when idempotent, a failed post is never replayed otherwise
+    :param timeout: seconds or (connect, read) tuple, None means the configured defaults
+    :param idempotent: whether the post can be safely sent twice
+    :param files: multipart files
+    :param headers:
+    :return: response obj
+    '''
+    return _send('POST', url, retry_times if idempotent else 1, timeout, data=data, files=files, headers=headers)
+
+
+class MultipartFileBody(object):
+    '''
+    multipart/form-data body of some fields and one file, read in chunks so the file is
+    never held in memory. it has a length and rewinds, so requests sends it with a
+    content length and a retry can send it again
+    '''
+
+    def __init__(self, fields, file_field, file_path, filename=None):
+        self.boundary = uuid.uuid4().hex
+        head = b''.join(b'--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (
+            self.boundary.encode(), name.encode('utf8'), str(value).encode('utf8')) for name, value in fields.items())
+        head += b'--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n' \
+                b'Content-Type: application/octet-stream\r\n\r\n' % (
+                    self.boundary.encode(), file_field.encode('utf8'),
+                    (filename or os.path.basename(file_path)).encode('utf8'))
+        self._parts = [head, file_path, b'\r\n--%s--\r\n' % self.boundary.encode()]
+        self._length = len(head) + os.path.getsize(file_path) + len(self._parts[2])
+        self._file = None
+        self.seek(0)
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return self._length
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise ValueError('a multipart body only rewinds to the start')
+        self.close()
+        self._part, self._part_offset, self._position = 0, 0, 0
+
+    def read(self, size=-1):
+        chunks = []
+        while self._part < len(self._parts) and (size < 0 or size > 0):
+            part = self._parts[self._part]
+            if isinstance(part, bytes):
+                chunk = part[self._part_offset:] if size < 0 else part[self._part_offset:self._part_offset + size]
+            else:
+                if self._file is None:
+                    self._file = open(part, 'rb')
+                chunk = self._file.read(size)
+            if not chunk:
+                self.close()
+                self._part, self._part_offset = self._part + 1, 0
+                continue
+            self._part_offset += len(chunk)
+            self._position += len(chunk)
+            if size > 0:
+                size -= len(chunk)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def request_stream(url, headers=None, timeout=None):
+    '''
+    open a streamed get, the body is read lazily by the caller who must close the response
+    :param url:
+    :param headers: e.g. Range
+    :param timeout: seconds or (connect, read) tuple, None means the configured defaults
+    :return: response obj, None if the daemon is unreachable
+    '''
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    try:
+        return get_session(url).get(url, headers=headers, timeout=timeout, stream=True)
+    except requests.RequestException as e:
+        logging.warning('request error %s: %s' % (url, e))
+        return None
 
 
-def request(request_type, url, data=None, retry_times=5, return_type="text"):
+def request(request_type, url, data=None, retry_times=HTTP_RETRY_TIMES, return_type="text", timeout=None,
+            idempotent=False):
     '''
 
     :param request_type: get/post
@@ -41,13 +184,15 @@ def request(request_type, url, data=None, retry_times=5, return_type="text"):
     :param data:
     :param retry_times:
     :param return_type: text/json
+    :param timeout: seconds or (connect, read) tuple, None means the configured defaults
+    :param idempotent: whether a post can be retried, gets are always retried
     :return:
     '''
     if request_type == 'get':
-        res = request_get(url, retry_times)
+        res = request_get(url, retry_times, timeout)
     if request_type == 'post':
-        res = request_post(url, data, retry_times)
-    if not res: return res
+        res = request_post(url, data, retry_times, timeout, idempotent)
+    if not res: return None
     if return_type == 'text': return res.text
     if return_type == 'json':
         try:
@@ -0,0 +1,202 @@
+import collections
+import gzip
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from SpiderKeeperX.app.util.http import request_stream
+from SpiderKeeperX.config import LOG_ARCHIVE_DIR, LOG_ARCHIVE_WORKERS, LOG_ARCHIVE_INDEX_MAX_LINES, \
+    LOG_STREAM_CHUNK_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_DEPLOY_READ_TIMEOUT
+
+logger = logging.getLogger("[LOG ARCHIVE]")
+
+INDEX_BATCH_SIZE = 1000
+LINE_ID_SPAN = 10 ** 7
+# lines past this are archived but not searchable
+MAX_INDEXED_LINES = min(LOG_ARCHIVE_INDEX_MAX_LINES, LINE_ID_SPAN - 1)
+
+
+def log_ref(job_execution):
+    '''
+    :return: (project_id, job_execution_id, key) of the archived log. ids are local to a database, the key
+     hashes the daemon and its job id so an archive is never served for another execution with the same id
+    '''
+    key = hashlib.sha1(('%s|%s' % (job_execution.running_on, job_execution.service_job_execution_id)).encode(
+        'utf8')).hexdigest()[:16]
+    return job_execution.project_id, job_execution.id, key
+
+
+class LogArchiver(object):
+    '''
+    keeps a gzip copy of the log of every finished job execution on local disk
+    and a sqlite fts5 index of their lines, so logs outlive the daemon log rotation
+    and can be searched without hitting daemons. archives are addressed by log_ref()
+    '''
+
+    def __init__(self, archive_dir=LOG_ARCHIVE_DIR, max_workers=LOG_ARCHIVE_WORKERS):
+        self.archive_dir = archive_dir
+        self.index_path = os.path.join(archive_dir, 'index.db')
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='skx-log-archive')
+        self._index_lock = threading.Lock()
+        self._index_ready = False
+
+    def _connect(self):
+        connection = sqlite3.connect(self.index_path, timeout=30)
+        if not self._index_ready:
+            # rowid is job_execution_id * LINE_ID_SPAN + line_no, so the lines of one log are a rowid range
+            columns = [row[1] for row in connection.execute('pragma table_info(log_line)')]
+            if columns and 'log_key' not in columns:
+                # lines indexed without a key cannot be told apart from another database's
+                connection.execute('drop table log_line')
+            connection.execute('create virtual table if not exists log_line using fts5(content, project_id unindexed, '
+                               'log_key unindexed)')
+            self._index_ready = True
+        return connection
+
+    def log_path(self, ref):
+        project_id, job_execution_id, key = ref
+        return os.path.join(self.archive_dir, str(project_id), '%s-%s.log.gz' % (job_execution_id, key))
+
+    def is_archived(self, job_execution):
+        return os.path.exists(self.log_path(log_ref(job_execution)))
+
+    def submit(self, job_execution, log_url):
+        '''
+        archive the log in the background
+        '''
+        return self._executor.submit(self.archive, log_ref(job_execution), log_url)
+
+    def archive(self, ref, log_url):
+        '''
+        download the log once into a gzip file and index its lines
+        :param ref: log_ref() of the job execution
+        :return: True if archived
+        '''
+        path = self.log_path(ref)
+        if os.path.exists(path):
+            return True
+        res = request_stream(log_url, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_DEPLOY_READ_TIMEOUT))
+        if res is None or res.status_code != 200:
+            logger.warning('fetch log failed %s' % log_url)
+            if res is not None:
+                res.close()
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        try:
+            with res, gzip.open(tmp_path, 'wb') as f:
+                for chunk in res.iter_content(LOG_STREAM_CHUNK_SIZE):
+                    f.write(chunk)
+            self._index(ref, tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning('archive log failed %s: %s' % (log_url, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        return True
+
+    def _index(self, ref, path):
+        project_id, job_execution_id, key = ref
+        first_rowid = job_execution_id * LINE_ID_SPAN
+        with self._index_lock:
+            connection = self._connect()
+            try:
+                # an interrupted archive may have left lines behind
+                connection.execute('delete from log_line where rowid between ? and ?',
+                                   (first_rowid, first_rowid + LINE_ID_SPAN - 1))
+                rows = []
+                with gzip.open(path, 'rb') as f:
+                    for line_no, line in enumerate(f, 1):
+                        if line_no > MAX_INDEXED_LINES:
+                            break
+                        rows.append((first_rowid + line_no, line.rstrip(b'\n').decode('utf8', errors='replace'),
+                                     project_id, key))
+                        if len(rows) >= INDEX_BATCH_SIZE:
+                            connection.executemany('insert into log_line(rowid, content, project_id, log_key) '
+                                                   'values (?, ?, ?, ?)', rows)
+                            rows = []
+                connection.executemany('insert into log_line(rowid, content, project_id, log_key) values (?, ?, ?, ?)',
+                                       rows)
+                connection.commit()
+            finally:
+                connection.close()
+
+    def iter_log(self, job_execution, offset=0):
+        '''
+        :return: chunks of the archived log starting at byte offset
+        '''
+        with gzip.open(self.log_path(log_ref(job_execution)), 'rb') as f:
+            if offset:
+                f.seek(offset)
+            while True:
+                chunk = f.read(LOG_STREAM_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    def read_tail(self, job_execution, size):
+        '''
+        :return: (last size bytes of the archived log, whether the log is longer than that)
+        '''
+        tail, total, truncated = collections.deque(), 0, False
+        for chunk in self.iter_log(job_execution):
+            tail.append(chunk)
+            total += len(chunk)
+            while total - len(tail[0]) >= size:
+                total -= len(tail.popleft())
+                truncated = True
+        data = b''.join(tail)
+        return data[-size:], truncated or len(data) > size
+
+    def search(self, query, project_id=None, limit=100):
+        '''
+        full text search of the archived log lines
+        :param query: fts5 match expression
+        :param project_id:
+        :param limit:
+        :return: [dict(project_id, job_execution_id, log_key, line_no, line)], raise ValueError on a bad query.
+         log_key is the key of log_ref(), lines whose key differs belong to another database
+        '''
+        if not os.path.exists(self.index_path):
+            return []
+        sql = 'select rowid, project_id, content, log_key from log_line where log_line match ?'
+        params = [query]
+        if project_id is not None:
+            sql += ' and project_id = ?'
+            params.append(project_id)
+        sql += ' order by rowid desc limit ?'
+        params.append(limit)
+        connection = self._connect()
+        try:
+            return [dict(project_id=row[1], job_execution_id=row[0] // LINE_ID_SPAN, log_key=row[3],
+                         line_no=row[0] % LINE_ID_SPAN, line=row[2]) for row in connection.execute(sql, params)]
+        except sqlite3.OperationalError as e:
+            raise ValueError(str(e))
+        finally:
+            connection.close()
+
+    def delete_many(self, refs):
+        '''
+        drop the archived logs of job executions and their indexed lines
+        :param refs: log_ref() of the job executions
+        '''
+        for ref in refs:
+            path = self.log_path(ref)
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.exists(self.index_path):
+            with self._index_lock:
+                connection = self._connect()
+                try:
+                    connection.executemany('delete from log_line where rowid between ? and ? and log_key = ?',
+                                           [(job_execution_id * LINE_ID_SPAN, (job_execution_id + 1) * LINE_ID_SPAN - 1,
+                                             key) for project_id, job_execution_id, key in refs])
+                    connection.commit()
+                finally:
+                    connection.close()
+
+log_archiver = LogArchiver()
@@ -0,0 +1,120 @@
+import bisect
+import threading
+
+# every metric created, in creation order
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')) for name, value in pairs)
+
+
+class Metric(object):
+    '''
+    a metric family in the prometheus text format, label values are passed as keyword arguments
+    '''
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def samples(self):
+        '''
+        :return: [(suffix, labelvalues, extra labels, value)]
+        '''
+        with self._lock:
+            return [('', key, (), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type)]
+        for suffix, labelvalues, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, _format_labels(self.labelnames, labelvalues, extra),
+                                        _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    '''
+    set explicitly, or read from callback() at scrape time which returns a value or {labelvalues: value}
+    '''
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        if not self.callback:
+            return super(Gauge, self).samples()
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [('', key if isinstance(key, tuple) else (key,), (), value) for key, value in values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        result = []
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                result.append(('_bucket', key, (('le', _format_value(bound)),), cumulative))
+            result.append(('_sum', key, (), total))
+            result.append(('_count', key, (), cumulative))
+        return result
+
+
+def render():
+    '''
+    :return: all metrics in the prometheus text exposition format
+    '''
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
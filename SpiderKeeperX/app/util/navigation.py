@@ -0,0 +1,53 @@
+from sqlalchemy import select
+
+from SpiderKeeperX.app.spider.model import Project, SpiderInstance, session
+from SpiderKeeperX.app.util.cache import VersionedCache
+from SpiderKeeperX.config import NAV_CACHE_TTL
+
+
+class NavigationCache(object):
+    '''
+    project list and per project spider lists of the page navigation. a project or spider change
+    drops the affected lists so the next render reloads them, changes made by another instance
+    are only seen after ttl seconds
+    '''
+
+    def __init__(self, ttl=NAV_CACHE_TTL):
+        self.ttl = ttl
+        # None -> [dict(id=, project_name=)]
+        self._projects = VersionedCache(ttl)
+        # project_id -> [spider dict]
+        self._spiders = VersionedCache(ttl)
+
+    def invalidate_projects(self, project_id=None, **payload):
+        self._projects.invalidate()
+        if project_id is not None:
+            self._spiders.invalidate(project_id)
+
+    def invalidate_spiders(self, project_id, **payload):
+        self._spiders.invalidate(project_id)
+
+    def projects(self):
+        return self._projects.load(None, lambda: [
+            dict(id=project_id, project_name=project_name) for project_id, project_name in
+            session.execute(select(Project.id, Project.project_name).order_by(Project.id))])
+
+    def spiders(self, project_id):
+        return self._spiders.load(project_id, lambda: [
+            spider_instance.to_dict() for spider_instance in
+            session.execute(select(SpiderInstance).filter_by(project_id=project_id)).scalars()])
+
+    def context(self, project_id=None):
+        '''
+        :param project_id: project of the page, the first project if None or unknown
+        :return: dict(project_list, project, spider_list)
+        '''
+        project_list = self.projects()
+        project = next((project for project in project_list if project['id'] == project_id),
+                       project_list[0] if project_list else None)
+        if not project:
+            return dict(project_list=project_list, project={})
+        return dict(project_list=project_list, project=project, spider_list=self.spiders(project['id']))
+
+
+navigation = NavigationCache()
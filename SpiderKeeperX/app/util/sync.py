@@ -1,30 +1,135 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import hashlib
+import os
+import shutil
 import tempfile
 import subprocess
+import threading
 from os import path
-from git import Repo
-from SpiderKeeperX.app import agent
+from git import Repo, GitCommandError
+from SpiderKeeperX.app.proxy.spiderctrl import agent
 from SpiderKeeperX.app.spider.model import Project
+from SpiderKeeperX.config import GIT_MIRROR_DIR, EGG_CACHE_DIR, EGG_CACHE_SIZE, BUILD_CONCURRENCY
 import logging
 
 logger = logging.getLogger("[GIT SYNC]")
 
-def git_sync(project_id, git_uri, git_folder):
+_mirror_locks = {}
+_mirror_locks_lock = threading.Lock()
+# clones and builds are cpu and disk heavy, a deploy storm queues here instead of running them all
+_build_slots = threading.BoundedSemaphore(BUILD_CONCURRENCY)
+
+
+def _mirror_lock(git_uri):
+    with _mirror_locks_lock:
+        return _mirror_locks.setdefault(git_uri, threading.Lock())
+
+
+def mirror_path(git_uri):
+    return path.join(GIT_MIRROR_DIR, hashlib.sha1(git_uri.encode('utf8')).hexdigest() + '.git')
+
+
+def update_mirror(git_uri):
+    """
+    clone a bare mirror of git_uri once, later calls only fetch what changed
+    :return: mirror Repo
+    """
+    mirror = mirror_path(git_uri)
+    with _mirror_lock(git_uri):
+        if path.exists(mirror):
+            repo = Repo(mirror)
+            logger.debug(f"fetching {git_uri} into {mirror}.")
+            repo.git.remote('update', '--prune')
+        else:
+            os.makedirs(GIT_MIRROR_DIR, exist_ok=True)
+            tmp_mirror = mirror + '.tmp'
+            shutil.rmtree(tmp_mirror, ignore_errors=True)
+            logger.debug(f"mirroring {git_uri} to {mirror}.")
+            Repo.clone_from(git_uri, tmp_mirror, mirror=True)
+            os.replace(tmp_mirror, mirror)
+            repo = Repo(mirror)
+    return repo
+
+
+def requirements_hash(repo, commit, spider_folder):
+    try:
+        requirements = repo.git.show('%s:%s' % (commit, path.join(spider_folder, 'requirements.txt').lstrip('/')))
+    except GitCommandError:
+        return ''
+    return hashlib.sha256(requirements.encode('utf8')).hexdigest()
+
+
+def egg_cache_path(git_uri, commit, spider_folder, requirements_sha256):
+    key = hashlib.sha256('\n'.join([git_uri, commit, spider_folder, requirements_sha256]).encode('utf8')).hexdigest()
+    return path.join(EGG_CACHE_DIR, key + '.egg')
+
+
+def prune_egg_cache():
+    """
+    keep the EGG_CACHE_SIZE most recently used eggs
+    """
+    eggs = [path.join(EGG_CACHE_DIR, name) for name in os.listdir(EGG_CACHE_DIR) if name.endswith('.egg')]
+    eggs.sort(key=lambda egg: path.getmtime(egg), reverse=True)
+    for egg in eggs[EGG_CACHE_SIZE:]:
+        try:
+            os.remove(egg)
+        except OSError:
+            pass
+
+
+def build_egg(git_uri, ref='HEAD', git_folder='', progress=None):
+    """
+    egg of git_uri at ref, built once per (repo, commit, folder, requirements)
+    :param progress: called with (percent, message) of the build
+    :return: (egg path, commit, whether it came from the cache)
+    """
+    progress = progress or (lambda percent, message: None)
+    spider_folder = git_folder.strip('/')
+    output_stem = spider_folder.replace('/', '_') if spider_folder else 'test'
+    progress(0, 'waiting for a build slot')
+    with _build_slots:
+        progress(10, f'fetching {git_uri}')
+        repo = update_mirror(git_uri)
+        commit = repo.git.rev_parse(ref + '^{commit}')
+        egg_path = egg_cache_path(git_uri, commit, spider_folder, requirements_hash(repo, commit, spider_folder))
+        if path.exists(egg_path):
+            os.utime(egg_path)
+            logger.debug(f"egg of {git_uri}@{commit} found in cache.")
+            return egg_path, commit, True
+        progress(30, f'building {commit}')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # a local clone of the mirror hardlinks its objects, nothing goes over the network
+            work_tree = Repo.clone_from(repo.git_dir, tmp_dir, no_checkout=True)
+            work_tree.git.checkout(commit)
+            spider_root = path.join(tmp_dir, spider_folder)
+            gen_egg(output_stem, spider_root)
+            os.makedirs(EGG_CACHE_DIR, exist_ok=True)
+            shutil.copyfile(path.join(spider_root, f"{output_stem}.egg"), egg_path + '.tmp')
+            os.replace(egg_path + '.tmp', egg_path)
+    prune_egg_cache()
+    return egg_path, commit, False
+
+
+def git_sync(project_id, git_uri, git_folder, ref='HEAD', progress=None):
     """
     git_uri: uri pointing to git repo.
     git_folder: path to spider root relative to git_uri
+    ref: branch, tag or commit, the default branch by default
+    progress: called with (percent, message), the build takes the first half and the deploy the rest
+    return: dict(commit, cached, deploy results by server)
     """
-    spider_folder = git_folder.strip('/')
-    output_stem = spider_folder if spider_folder else 'test'
+    progress = progress or (lambda percent, message: None)
     project = Project.find_project_by_id(project_id)
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        logger.debug(f"cloning from {git_uri} to {tmp_dir}.")
-        Repo.clone_from(git_uri, tmp_dir)
-        spider_root = path.join(tmp_dir, spider_folder)
-        gen_egg(output_stem, spider_root)
-        egg_path = path.join(spider_root, f"{output_stem}.egg")
-        agent.deploy(project, egg_path)
+    egg_path, commit, cached = build_egg(git_uri, ref, git_folder,
+                                         progress=lambda percent, message: progress(percent // 2, message))
+    progress(50, f'deploying {commit}')
+    # a cached egg is byte identical, so daemons already running it are skipped by the deploy
+    results = agent.deploy(project, egg_path, progress=lambda done, total: progress(
+        50 + 50 * done // max(total, 1), f'deployed {commit} to {done}/{total} daemons'))
+    logger.info(f"synced {git_uri}@{commit} to project {project.project_name}, egg cached: {cached}.")
+    return dict(commit=commit, cached=cached, results=results)
+
 
 def gen_egg(output_stem, cwd):
     cmd_lst = ["scrapyd-deploy", "--build-egg", f"{output_stem}.egg"]
@@ -32,5 +137,5 @@ def gen_egg(output_stem, cwd):
         cmd_lst.append("--include-dependencies")
     logger.debug(f"generating egg file")
     p = subprocess.Popen(cmd_lst, cwd=cwd)
-    p.wait()
-
+    if p.wait() != 0:
+        raise RuntimeError(f"scrapyd-deploy --build-egg failed with exit code {p.returncode} in {cwd}")
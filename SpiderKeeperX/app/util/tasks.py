@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from SpiderKeeperX.app.proxy.spiderctrl import agent
+from SpiderKeeperX.app.spider.model import BackgroundTask, Project, TaskStatus, DeployStatus, session
+from SpiderKeeperX.app.util.metrics import Counter, Gauge, Histogram
+from SpiderKeeperX.app.util.sync import git_sync
+from SpiderKeeperX.config import TASK_WORKERS, TASK_STALE_SECONDS, TASK_WORKER_ID
+
+logger = logging.getLogger("[TASK]")
+
+DEPLOY = 'deploy'
+GIT_SYNC = 'git_sync'
+
+
+class TaskError(Exception):
+    '''
+    a failed task that still has a result worth keeping, like the deploy of every daemon
+    '''
+
+    def __init__(self, message, result=None):
+        super(TaskError, self).__init__(message)
+        self.result = result
+
+
+class TaskRunner(object):
+    '''
+    runs egg deploys and git syncs in worker threads, off the request path. every task is a row
+    of skx_task, so its status and progress can be polled after the request that queued it is gone.
+    a task is only run and recovered by the worker_id that queued it, the one holding its upload
+    '''
+
+    def __init__(self, workers=TASK_WORKERS, worker_id=TASK_WORKER_ID):
+        self.workers = workers
+        self.worker_id = worker_id
+        # kind -> handler(project_id, progress=, **params) returning the task result
+        self.handlers = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def _start_workers(self):
+        with self._lock:
+            if self._threads:
+                return False
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name='skx-task-%s' % i, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            return True
+
+    def start(self):
+        '''
+        start the workers and pick up the tasks this worker_id left pending in the last run
+        '''
+        if not self._start_workers():
+            return
+        try:
+            stale = BackgroundTask.fail_stale(TASK_STALE_SECONDS, self.worker_id)
+            if stale:
+                logger.warning('%s running tasks without progress marked failed' % stale)
+            for task_id in BackgroundTask.list_pending_ids(self.worker_id):
+                self._queue.put(task_id)
+        finally:
+            session.remove()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def submit(self, project_id, kind, **params):
+        '''
+        persist a task and queue it
+        :param project_id:
+        :param kind: a registered kind
+        :param params: json serializable keyword arguments of the handler
+        :return: task id
+        '''
+        if kind not in self.handlers:
+            raise ValueError('unknown task kind %s' % kind)
+        task = BackgroundTask.create(project_id, kind, params, self.worker_id)
+        self._start_workers()
+        self._queue.put(task.id)
+        return task.id
+
+    def run(self, task_id):
+        '''
+        run one task, a task already claimed or queued by another worker_id is skipped
+        '''
+        if not BackgroundTask.claim(task_id, self.worker_id):
+            return
+        task = session.get(BackgroundTask, task_id)
+        kind, project_id, params = task.kind, task.project_id, json.loads(task.params or '{}')
+        start = time.perf_counter()
+        try:
+            result = self.handlers[kind](project_id, progress=lambda percent, message=None: BackgroundTask.report(
+                task_id, percent, message), **params)
+        except Exception as e:
+            logger.exception('task %s (%s) failed' % (task_id, kind))
+            session.rollback()
+            status, message, result = TaskStatus.FAILED, str(e), getattr(e, 'result', None)
+        else:
+            status, message = TaskStatus.SUCCESS, None
+        BackgroundTask.finish(task_id, status, message, result)
+        TASK_SECONDS.observe(time.perf_counter() - start, kind=kind)
+        TASKS.inc(kind=kind, status=status)
+
+    def _run(self):
+        while True:
+            task_id = self._queue.get()
+            try:
+                self.run(task_id)
+            except Exception as e:
+                logger.error('task %s could not be run: %s' % (task_id, e))
+                session.rollback()
+            finally:
+                session.remove()
+
+
+def deploy_task(project_id, file_path, force=False, progress=None):
+    '''
+    deploy an uploaded egg, the upload is removed once done
+    '''
+    try:
+        project = Project.find_project_by_id(project_id)
+        results = agent.deploy(project, file_path, force=force, progress=lambda done, total: progress(
+            100 * done // max(total, 1), 'deployed to %s/%s daemons' % (done, total)))
+    finally:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    return _check_deploy(dict(results=results))
+
+
+def git_sync_task(project_id, git_uri, git_folder, ref='HEAD', progress=None):
+    return _check_deploy(git_sync(project_id, git_uri, git_folder, ref=ref, progress=progress))
+
+
+def _check_deploy(result):
+    failed = [server for server, deploy in result['results'].items() if deploy['status'] == DeployStatus.FAILED]
+    if failed:
+        raise TaskError('deploy failed on %s' % ', '.join(sorted(failed)), result)
+    return result
+
+
+task_runner = TaskRunner()
+task_runner.register(DEPLOY, deploy_task)
+task_runner.register(GIT_SYNC, git_sync_task)
+
+TASKS = Counter('skx_tasks_total', 'background tasks finished', ['kind', 'status'])
+TASK_SECONDS = Histogram('skx_task_seconds', 'run time of background tasks', ['kind'])
+Gauge('skx_task_queue_depth', 'background tasks waiting for a worker', callback=task_runner.qsize)
@@ -0,0 +1,208 @@
+'''
+in-process fake scrapyd daemons for the benchmarks, with injectable latency and failures
+'''
+import json
+import random
+import threading
+import time
+import uuid
+import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from collections import Counter
+
+
+class FakeScrapyd(object):
+    '''
+    a scrapyd answering listprojects, listspiders, listjobs, daemonstatus, schedule, cancel,
+    delproject, addversion and logs. a scheduled job is pending for pending_seconds, then runs
+    for job_seconds, None keeps it running until finish_all
+    '''
+
+    def __init__(self, latency=0, failure_rate=0, pending_seconds=0, job_seconds=None, log_lines=1000, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.pending_seconds = pending_seconds
+        self.job_seconds = job_seconds
+        self.log_lines = log_lines
+        self.projects = {}  # project -> [spider]
+        self.jobs = {}  # job id -> dict(project, spider, scheduled_at, canceled)
+        self.calls = Counter()
+        self.failures = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _handler(self))
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_job(self, project, spider, status='running'):
+        '''
+        seed a job, status pending/running/finished
+        :return: job id
+        '''
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        scheduled_at = {'pending': now, 'running': now - self.pending_seconds,
+                        'finished': now - self.pending_seconds - (self.job_seconds or 0) - 1}[status]
+        with self._lock:
+            self.jobs[job_id] = dict(project=project, spider=spider, scheduled_at=scheduled_at,
+                                     finished=status == 'finished')
+        return job_id
+
+    def finish_all(self):
+        with self._lock:
+            for job in self.jobs.values():
+                job['finished'] = True
+
+    def job_status(self, job):
+        elapsed = time.time() - job['scheduled_at']
+        if job['finished'] or (self.job_seconds is not None and elapsed >= self.pending_seconds + self.job_seconds):
+            return 'finished'
+        return 'pending' if elapsed < self.pending_seconds else 'running'
+
+    def should_fail(self):
+        return self.failure_rate and self._random.random() < self.failure_rate
+
+
+def _format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def _handler(daemon):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, obj=None, code=200, raw=None):
+            body = raw if raw is not None else json.dumps(obj).encode('utf8')
+            self.send_response(code)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _begin(self, path):
+            daemon.calls[path] += 1
+            if daemon.latency:
+                time.sleep(daemon.latency)
+            if daemon.should_fail():
+                daemon.failures[path] += 1
+                self._send({'status': 'error', 'message': 'injected failure'}, code=503)
+                return False
+            return True
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if not self._begin(url.path):
+                return
+            project = query.get('project', [None])[0]
+            if url.path == '/listprojects.json':
+                return self._send({'status': 'ok', 'projects': list(daemon.projects)})
+            if url.path == '/listspiders.json':
+                return self._send({'status': 'ok', 'spiders': daemon.projects.get(project, [])})
+            if url.path in ('/listjobs.json', '/daemonstatus.json'):
+                result = {'pending': [], 'running': [], 'finished': []}
+                with daemon._lock:
+                    jobs = list(daemon.jobs.items())
+                for job_id, job in jobs:
+                    if project and job['project'] != project:
+                        continue
+                    status = daemon.job_status(job)
+                    item = {'id': job_id, 'project': job['project'], 'spider': job['spider']}
+                    if status != 'pending':
+                        item['start_time'] = _format_time(job['scheduled_at'] + daemon.pending_seconds)
+                    if status == 'finished':
+                        item['end_time'] = _format_time(time.time())
+                    result[status].append(item)
+                if url.path == '/daemonstatus.json':
+                    return self._send({'status': 'ok', 'node_name': 'fake', 'pending': len(result['pending']),
+                                       'running': len(result['running']), 'finished': len(result['finished'])})
+                result['status'] = 'ok'
+                return self._send(result)
+            if url.path.startswith('/logs/'):
+                return self._send(raw=b''.join(b'%d INFO fake log line\n' % i for i in range(daemon.log_lines)))
+            self._send({'status': 'error'}, code=404)
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            if not self._begin(url.path):
+                return
+            if url.path == '/addversion.json':
+                return self._send({'status': 'ok', 'spiders': 1})
+            form = parse_qs(body.decode('utf8', errors='replace'))
+            if url.path == '/schedule.json':
+                project, spider = form['project'][0], form['spider'][0]
+                job_id = uuid.uuid4().hex
+                with daemon._lock:
+                    daemon.jobs[job_id] = dict(project=project, spider=spider, scheduled_at=time.time(),
+                                               finished=False)
+                return self._send({'status': 'ok', 'jobid': job_id})
+            if url.path == '/cancel.json':
+                with daemon._lock:
+                    job = daemon.jobs.get(form['job'][0])
+                    if job:
+                        job['finished'] = True
+                return self._send({'status': 'ok', 'prevstate': 'running'})
+            if url.path == '/delproject.json':
+                daemon.projects.pop(form['project'][0], None)
+                return self._send({'status': 'ok'})
+            self._send({'status': 'error'}, code=404)
+
+    return Handler
+
+
+class FakeScrapydCluster(object):
+    def __init__(self, size, **kwargs):
+        self.daemons = [FakeScrapyd(seed=i, **kwargs) for i in range(size)]
+
+    def start(self):
+        for daemon in self.daemons:
+            daemon.start()
+        return self
+
+    def stop(self):
+        for daemon in self.daemons:
+            daemon.stop()
+
+    @property
+    def urls(self):
+        return [daemon.url for daemon in self.daemons]
+
+    def add_project(self, project, spiders):
+        for daemon in self.daemons:
+            daemon.projects[project] = list(spiders)
+
+    def set(self, **kwargs):
+        '''
+        change latency / failure_rate / job_seconds of every daemon
+        '''
+        for daemon in self.daemons:
+            for key, value in kwargs.items():
+                setattr(daemon, key, value)
+
+    def calls(self):
+        result = Counter()
+        for daemon in self.daemons:
+            result.update(daemon.calls)
+        return dict(result)
+
+    def failures(self):
+        result = Counter()
+        for daemon in self.daemons:
+            result.update(daemon.failures)
+        return dict(result)
@@ -0,0 +1,396 @@
+'''
+benchmarks of the SpiderKeeperX control plane against a cluster of in-process fake scrapyd daemons.
+
+    python benchmarks/run.py --daemons 10 --projects 20 --executions 200000 --output report.json
+
+seeds a throwaway database, then measures the status sync tick, the scheduler jobs, the daemon
+http client with and without connection pooling, launch throughput, dashboard and api latency, requests per second of the app served over http to
+--clients concurrent clients and memory, and writes a json report. reports of two runs with
+the same arguments are comparable
+'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_scrapyd import FakeScrapydCluster
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='SpiderKeeperX control plane benchmarks')
+    parser.add_argument('--daemons', type=int, default=5)
+    parser.add_argument('--projects', type=int, default=10)
+    parser.add_argument('--spiders', type=int, default=20, help='spiders per project')
+    parser.add_argument('--periodic-jobs', type=int, default=200, help='periodic job instances per project')
+    parser.add_argument('--executions', type=int, default=50000, help='completed job executions in total')
+    parser.add_argument('--running', type=int, default=500, help='running job executions in total')
+    parser.add_argument('--launches', type=int, default=500, help='launches of the launch benchmark')
+    parser.add_argument('--sync-ticks', type=int, default=20)
+    parser.add_argument('--route-requests', type=int, default=50, help='requests per route')
+    parser.add_argument('--clients', type=int, default=50, help='concurrent clients of the load test')
+    parser.add_argument('--http-requests', type=int, default=2000,
+                        help='listjobs calls of each side of the daemon http client comparison')
+    parser.add_argument('--load-seconds', type=float, default=10, help='duration of the load test')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds each fake daemon call takes')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of fake daemon calls answered 503')
+    parser.add_argument('--dispatch-workers', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', default=None, help='sqlalchemy url, a temporary sqlite file by default')
+    parser.add_argument('--output', default=None, help='report path, stdout by default')
+    return parser.parse_args(argv)
+
+
+def summarize(durations):
+    '''
+    :param durations: seconds
+    :return: dict of count, mean and percentiles in milliseconds
+    '''
+    if not durations:
+        return dict(count=0)
+    values = sorted(durations)
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))] * 1000
+
+    return dict(count=len(values), mean_ms=sum(values) / len(values) * 1000, p50_ms=percentile(50),
+                p95_ms=percentile(95), p99_ms=percentile(99), max_ms=values[-1] * 1000)
+
+
+class Phase(object):
+    '''
+    times a benchmark phase and records its python heap peak
+    '''
+
+    def __init__(self, report, name):
+        self.report = report
+        self.name = name
+
+    def __enter__(self):
+        tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        current, peak = tracemalloc.get_traced_memory()
+        self.report['memory'][self.name] = dict(heap_peak_mb=peak / 1024 / 1024,
+                                                duration_s=time.perf_counter() - self.start)
+
+
+def seed(args, cluster, models, session):
+    Project, SpiderInstance, JobInstance, JobExecution, SpiderStatus = models
+    from sqlalchemy import insert
+    rnd = random.Random(args.seed)
+    projects = []
+    for i in range(args.projects):
+        project = Project(project_name='project_%s' % i)
+        session.add(project)
+        projects.append(project)
+    session.commit()
+    now = datetime.datetime.now()
+    for project in projects:
+        spiders = ['spider_%s' % i for i in range(args.spiders)]
+        cluster.add_project(project.project_name, spiders)
+        session.execute(insert(SpiderInstance), [dict(project_id=project.id, spider_name=spider) for spider in spiders])
+        session.execute(insert(JobInstance), [dict(
+            project_id=project.id, spider_name=spiders[i % len(spiders)], priority=rnd.choice([-1, 0, 1, 2]),
+            run_type='periodic', enabled=0, cron_minutes=str(i % 60), cron_hour='*', cron_day_of_month='*',
+            cron_day_of_week='*', cron_month='*') for i in range(args.periodic_jobs)])
+        session.execute(insert(JobInstance), [dict(
+            project_id=project.id, spider_name=spider, priority=0, run_type='onetime', enabled=-1)
+            for spider in spiders])
+    session.commit()
+    job_instances = dict(((job_instance.project_id, job_instance.spider_name), job_instance.id) for job_instance in
+                         session.query(JobInstance).filter_by(run_type='onetime'))
+    rows = []
+
+    def flush():
+        if rows:
+            session.execute(insert(JobExecution), rows)
+            session.commit()
+            del rows[:]
+
+    for i in range(args.executions):
+        project = projects[i % len(projects)]
+        spider = 'spider_%s' % rnd.randrange(args.spiders)
+        modified = now - datetime.timedelta(seconds=rnd.randrange(90 * 86400))
+        rows.append(dict(project_id=project.id, job_instance_id=job_instances[(project.id, spider)],
+                         service_job_execution_id='seed_%s' % i, create_time=modified, start_time=modified,
+                         end_time=modified, running_status=rnd.choice([SpiderStatus.FINISHED, SpiderStatus.CANCELED]),
+                         running_on=rnd.choice(cluster.daemons).url, date_created=modified, date_modified=modified))
+        if len(rows) >= 10000:
+            flush()
+    for i in range(args.running):
+        project = projects[i % len(projects)]
+        spider = 'spider_%s' % rnd.randrange(args.spiders)
+        daemon = rnd.choice(cluster.daemons)
+        rows.append(dict(project_id=project.id, job_instance_id=job_instances[(project.id, spider)],
+                         service_job_execution_id=daemon.add_job(project.project_name, spider, 'running'),
+                         create_time=now, start_time=now, running_status=SpiderStatus.RUNNING, running_on=daemon.url))
+    flush()
+    return projects
+
+
+def bench_sync(args, agent, projects):
+    durations = []
+    for i in range(args.sync_ticks):
+        durations.append(agent.sync_all_job_status(projects))
+    return summarize(durations)
+
+
+def bench_schedulers(args, common, scheduler, session):
+    result = {}
+    start = time.perf_counter()
+    common.reload_runnable_spider_job_execution()
+    result['reload_cold'] = summarize([time.perf_counter() - start])
+    result['scheduled_jobs'] = len(scheduler.get_jobs(jobstore='spider'))
+    durations = []
+    for i in range(10):
+        start = time.perf_counter()
+        common.reload_runnable_spider_job_execution()
+        durations.append(time.perf_counter() - start)
+    result['reload_unchanged'] = summarize(durations)
+    start = time.perf_counter()
+    common.sync_spiders()
+    result['sync_spiders'] = summarize([time.perf_counter() - start])
+    session.remove()
+    return result
+
+
+def bench_launch(args, agent, dispatch, JobInstance, session):
+    job_instances = list(session.query(JobInstance).filter_by(run_type='periodic', priority=0).limit(args.launches))
+    # a job instance already waiting in the queue is coalesced, so each round submits distinct ones and waits
+    done = threading.Semaphore(0)
+
+    class CountingDispatcher(dispatch.LaunchDispatcher):
+        def dispatch(self, item):
+            try:
+                super(CountingDispatcher, self).dispatch(item)
+            finally:
+                done.release()
+
+    dispatcher = CountingDispatcher(agent, workers=args.dispatch_workers, rate=0)
+    launched = 0
+    start = time.perf_counter()
+    while launched < args.launches and job_instances:
+        batch = job_instances[:args.launches - launched]
+        for job_instance in batch:
+            dispatcher.submit(job_instance)
+        for job_instance in batch:
+            done.acquire()
+        launched += len(batch)
+    duration = time.perf_counter() - start
+    return dict(launches=launched, seconds=duration, launches_per_s=launched / duration if duration else None)
+
+
+def bench_routes(args, client, project_id):
+    routes = [
+        '/project/{project_id}/job/dashboard',
+        '/project/{project_id}/job/periodic',
+        '/project/{project_id}/spider/dashboard',
+        '/project/{project_id}/project/stats',
+        '/api/project/{project_id}/jobexecs',
+        '/api/project/{project_id}/jobexecs?limit=1000',
+        '/api/daemons',
+        '/metrics',
+    ]
+    result = {}
+    for route in routes:
+        durations, status_codes = [], {}
+        for i in range(args.route_requests):
+            start = time.perf_counter()
+            response = client.get(route.format(project_id=project_id))
+            durations.append(time.perf_counter() - start)
+            status_codes[response.status_code] = status_codes.get(response.status_code, 0) + 1
+        result[route] = dict(summarize(durations), status_codes=status_codes)
+    return result
+
+
+def bench_daemon_http(args, cluster):
+    '''
+    listjobs calls to the fake daemons from SYNC_MAX_WORKERS threads, once with a new connection
+    per call like the client before pooling and once through the pooled keep-alive client
+    '''
+    import requests
+    from SpiderKeeperX.app.util.http import request_get
+    from SpiderKeeperX.config import SYNC_MAX_WORKERS, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+    urls = ['%s/listjobs.json?project=project_0' % url for url in cluster.urls]
+
+    def unpooled(url):
+        return requests.get(url, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), headers={'Connection': 'close'})
+
+    def pooled(url):
+        return request_get(url, retry_times=1)
+
+    result = {}
+    for name, call in (('unpooled', unpooled), ('pooled', pooled)):
+        calls = iter(range(args.http_requests))
+        durations, failures = [], [0]
+        lock = threading.Lock()
+
+        def worker():
+            for i in calls:
+                start = time.perf_counter()
+                response = call(urls[i % len(urls)])
+                duration = time.perf_counter() - start
+                with lock:
+                    durations.append(duration)
+                    if response is None or response.status_code != 200:
+                        failures[0] += 1
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=worker) for i in range(SYNC_MAX_WORKERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        result[name] = dict(summarize(durations), requests_per_s=len(durations) / elapsed, failures=failures[0])
+    result['speedup'] = result['pooled']['requests_per_s'] / result['unpooled']['requests_per_s']
+    return result
+
+
+LOAD_ROUTES = [
+    '/project/{project_id}/job/dashboard',
+    '/api/project/{project_id}/jobexecs',
+    '/api/daemons',
+]
+
+
+def bench_load(args, app, project_id):
+    '''
+    args.clients concurrent keep-alive clients against the app served by uvicorn over real http
+    for args.load_seconds, each client cycles through LOAD_ROUTES
+    '''
+    import socket
+    import requests
+    import uvicorn
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    base_url = 'http://127.0.0.1:%d' % sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, log_level='warning', limit_concurrency=args.clients * 2))
+    thread = threading.Thread(target=server.run, kwargs=dict(sockets=[sock]), daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    samples = dict((route, []) for route in LOAD_ROUTES)
+    status_codes = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.load_seconds
+
+    def client(index):
+        http_session = requests.Session()
+        i = index
+        while time.perf_counter() < deadline:
+            route = LOAD_ROUTES[i % len(LOAD_ROUTES)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                code = http_session.get(base_url + route.format(project_id=project_id), timeout=30).status_code
+            except requests.RequestException:
+                code = 'error'
+            duration = time.perf_counter() - start
+            with lock:
+                samples[route].append(duration)
+                status_codes[code] = status_codes.get(code, 0) + 1
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    for client_thread in clients:
+        client_thread.start()
+    for client_thread in clients:
+        client_thread.join()
+    elapsed = time.perf_counter() - start
+    server.should_exit = True
+    thread.join()
+    total = sum(len(durations) for durations in samples.values())
+    return dict(clients=args.clients, seconds=elapsed, requests=total, requests_per_s=total / elapsed,
+                latency=summarize([duration for durations in samples.values() for duration in durations]),
+                status_codes=status_codes,
+                routes=dict((route, dict(summarize(durations), requests_per_s=len(durations) / elapsed))
+                            for route, durations in samples.items()))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    tmp_dir = tempfile.mkdtemp(prefix='skx-bench-')
+    os.environ['SPIDERKEEPERX_DATABASE_URI'] = args.database or 'sqlite:///' + os.path.join(tmp_dir, 'bench.db')
+    # templates are looked up relative to the working directory
+    os.chdir(ROOT)
+    tracemalloc.start()
+    report = dict(version=1, config=vars(args), memory={}, results={}, environment=dict(
+        python=platform.python_version(), platform=platform.platform(), started=datetime.datetime.now().isoformat()))
+
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from SpiderKeeperX.app import init_db, scheduler
+    from SpiderKeeperX.app.proxy import spiderctrl, dispatch
+    from SpiderKeeperX.app.proxy.contrib.scrapy import ScrapydProxy
+    from SpiderKeeperX.app.schedulers import common
+    from SpiderKeeperX.app.spider.controller import api_router
+    from SpiderKeeperX.app.spider.model import Project, SpiderInstance, JobInstance, JobExecution, SpiderStatus, \
+        SessionScopeMiddleware, RequestMetricsMiddleware, session
+
+    cluster = FakeScrapydCluster(args.daemons, latency=args.latency, failure_rate=args.failure_rate).start()
+    try:
+        init_db()
+        agent = spiderctrl.agent
+        # measure the control plane, not the log download
+        spiderctrl.LOG_ARCHIVE_ENABLED = False
+        for url in cluster.urls:
+            agent.regist(ScrapydProxy(url))
+        with Phase(report, 'seed'):
+            projects = seed(args, cluster, (Project, SpiderInstance, JobInstance, JobExecution, SpiderStatus),
+                            session)
+        session.remove()
+        projects = list(session.query(Project))
+        project_id = projects[0].id
+        scheduler.start(paused=True)
+        with Phase(report, 'sync'):
+            report['results']['sync_tick'] = bench_sync(args, agent, projects)
+        with Phase(report, 'schedulers'):
+            report['results']['schedulers'] = bench_schedulers(args, common, scheduler, session)
+        with Phase(report, 'daemon_http'):
+            report['results']['daemon_http'] = bench_daemon_http(args, cluster)
+        with Phase(report, 'launch'):
+            report['results']['launch'] = bench_launch(args, agent, dispatch, JobInstance, session)
+        app = FastAPI()
+        app.add_middleware(SessionScopeMiddleware)
+        app.add_middleware(RequestMetricsMiddleware)
+        app.include_router(api_router)
+        with Phase(report, 'routes'), TestClient(app, raise_server_exceptions=False) as client:
+            report['results']['routes'] = bench_routes(args, client, project_id)
+        # heap tracing slows every allocation, the load test measures throughput without it
+        tracemalloc.stop()
+        report['results']['load'] = bench_load(args, app, project_id)
+        tracemalloc.start()
+        report['results']['daemon_calls'] = cluster.calls()
+        report['results']['daemon_failures'] = cluster.failures()
+        report['memory']['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        # a stopped scheduler wakes once more, leave it nothing due
+        scheduler.remove_all_jobs()
+        scheduler.shutdown(wait=False)
+    finally:
+        cluster.stop()
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return report
+
+
+if __name__ == '__main__':
+    main()